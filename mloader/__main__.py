@@ -1,32 +1,83 @@
 import logging
+import os
+import queue
 import re
+import signal
 import sys
 from functools import partial
-from typing import Optional, Set
+from logging.handlers import QueueListener
+from typing import List, Optional, Set, TextIO
 
 import click
 
-from mloader import __version__ as about
-from mloader.exporter import RawExporter, CBZExporter
+from mloader import __version__ as about, s3, transform
+from mloader.blobstore import BlobStore, BlobStoreExporter
+from mloader.dedupe import LINK_MODES, Deduplicator, dedupe_library
+from mloader.exporter import (
+    STREAM_FORMATS,
+    ArchiveStream,
+    ArchiveWriter,
+    CBZExporter,
+    RawExporter,
+    StreamExporter,
+)
 from mloader.loader import MangaLoader
+from mloader.manifest import LibraryManifest
+from mloader.logs import LOG_FORMATS, JSONFormatter, LazyQueueHandler
+from mloader.profiling import PROFILE_MODES, Profiler
+from mloader.progress import PROGRESS_MODES
+from mloader.schedule import SCHEDULES
+from mloader.trace import Tracer
+from mloader.transport import (
+    LiveTransport,
+    RecordingTransport,
+    ReplayTransport,
+)
+from mloader.verify import IMAGE_EXTENSIONS, find_library_files, scan_library
 
 log = logging.getLogger()
 
 
-def setup_logging():
+_listener: Optional[QueueListener] = None
+
+
+def setup_logging(log_format: str = "text", stream: TextIO = sys.stdout):
+    global _listener
     for logger in ("requests", "urllib3"):
         logging.getLogger(logger).setLevel(logging.WARNING)
-    handlers = [logging.StreamHandler(sys.stdout)]
+    stop_logging()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    handler = logging.StreamHandler(stream)
+    if log_format != "json":
+        handler.setFormatter(
+            logging.Formatter(
+                "{asctime:^} | {levelname: ^8} | "
+                "{filename: ^14} {lineno: <4} | {message}",
+                datefmt="%d.%m.%Y %H:%M:%S",
+                style="{",
+            )
+        )
+        logging.basicConfig(handlers=[handler], level=logging.INFO)
+        return
+    # Records are formatted and written on a background thread, so a slow
+    # stdout doesn't stall the download
+    handler.setFormatter(JSONFormatter())
+    records = queue.Queue()
+    _listener = QueueListener(records, handler)
     logging.basicConfig(
-        handlers=handlers,
-        format=(
-            "{asctime:^} | {levelname: ^8} | "
-            "{filename: ^14} {lineno: <4} | {message}"
-        ),
-        style="{",
-        datefmt="%d.%m.%Y %H:%M:%S",
-        level=logging.INFO,
+        handlers=[LazyQueueHandler(records)], level=logging.INFO
     )
+    _listener.start()
+
+
+def stop_logging():
+    # Writes out records still queued by the JSON logging thread
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
 
 
 setup_logging()
@@ -50,6 +101,61 @@ def validate_urls(ctx: click.Context, param, value):
     ctx.params.setdefault("chapters", set()).update(res["viewer"])
 
 
+def handle_stop_signals(loader: MangaLoader) -> List[int]:
+    # The first SIGTERM or SIGINT lets the loader drain and save its state,
+    # a second one aborts right away
+    received = []
+
+    def stop(signum, frame):
+        if received:
+            raise KeyboardInterrupt
+        received.append(signum)
+        loader.stop()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, stop)
+    return received
+
+
+def validate_profile_modes(ctx: click.Context, param, value):
+    if not value:
+        return []
+    modes = [m.strip() for m in value.split(",") if m.strip()]
+    for mode in modes:
+        if mode not in PROFILE_MODES:
+            raise click.BadParameter(
+                f"Unknown profiler: {mode}, "
+                f"choose from {', '.join(PROFILE_MODES)}"
+            )
+    return modes
+
+
+EXPORTERS = {
+    "cbz": CBZExporter,
+    "raw": RawExporter,
+    "tar": StreamExporter,
+    "zip": StreamExporter,
+    "sqlite": BlobStoreExporter,
+}
+
+
+# Used instead of EXPORTERS when saving to an s3:// url
+S3_EXPORTERS = {"cbz": s3.S3CBZExporter, "raw": s3.S3RawExporter}
+
+
+def validate_formats(ctx: click.Context, param, value):
+    if not value:
+        return []
+    formats = [f.strip().lower() for f in value.split(",") if f.strip()]
+    for f in formats:
+        if f not in EXPORTERS:
+            raise click.BadParameter(
+                f"Unknown format: {f}, expected one of "
+                f"{', '.join(EXPORTERS)}"
+            )
+    return list(dict.fromkeys(formats))
+
+
 def validate_ids(ctx: click.Context, param, value):
     if not value:
         return value
@@ -77,11 +183,108 @@ Examples:
 
     $ mloader https://mangaplus.shueisha.co.jp/viewer/1 
     https://mangaplus.shueisha.co.jp/titles/2 -r -q low
+
+{click.style('• check previously downloaded chapters for corrupt pages',
+fg="green")}
+
+    $ mloader verify mloader_downloads
+
+{click.style('• replace pages repeated across chapters with hardlinks',
+fg="green")}
+
+    $ mloader dedupe mloader_downloads
 """
 
 
-@click.command(
+class DefaultCommandGroup(click.Group):
+    # Arguments that don't start with a known command are passed to the
+    # default one, so `mloader <urls>` keeps working next to subcommands
+    def __init__(self, *args, default_command: str, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.default_command = default_command
+
+    def parse_args(self, ctx: click.Context, args):
+        position = self._command_position(ctx, args)
+        # `mloader --help` shows the commands and the group's own options
+        if position == len(args) or (
+            args[position] not in self.commands
+            and args[position] not in ctx.help_option_names
+        ):
+            args = [*args[:position], self.default_command, *args[position:]]
+        return super().parse_args(ctx, args)
+
+    def _command_position(self, ctx: click.Context, args) -> int:
+        # Skips options of the group itself, e.g. `mloader --profile cpu <urls>`
+        options = {
+            opt: param
+            for param in self.get_params(ctx)
+            for opt in param.opts
+            if opt not in ctx.help_option_names
+        }
+        position = 0
+        while position < len(args):
+            param = options.get(args[position].split("=", 1)[0])
+            if param is None:
+                break
+            takes_value = not param.is_flag and "=" not in args[position]
+            position += 2 if takes_value else 1
+        return min(position, len(args))
+
+
+@click.group(
+    cls=DefaultCommandGroup,
+    default_command="download",
+    help=f"{about.__description__}\n\nArguments that don't start with a "
+    "command are passed to `download`. Options of mloader itself go "
+    "before the command or urls.",
+    epilog=EPILOG,
+)
+@click.option(
+    "--profile",
+    "profile_modes",
+    metavar="<modes>",
+    callback=validate_profile_modes,
+    help="Comma separated profilers to run: cpu (cProfile), memory "
+    "(tracemalloc at chapter boundaries), sample (wall time sampling)",
+    envvar="MLOADER_PROFILE",
+)
+@click.option(
+    "--profile-dir",
+    type=click.Path(file_okay=False, writable=True),
+    metavar="<directory>",
+    default="mloader_profile",
+    show_default=True,
+    help="Where profiling results are written",
+    envvar="MLOADER_PROFILE_DIR",
+)
+@click.option(
+    "--log-format",
+    type=click.Choice(LOG_FORMATS),
+    default="text",
+    show_default=True,
+    help="Log output: human readable lines, or JSON lines written from a "
+    "background thread",
+    envvar="MLOADER_LOG_FORMAT",
+)
+@click.pass_context
+def main(
+    ctx: click.Context,
+    profile_modes: List[str],
+    profile_dir: str,
+    log_format: str,
+):
+    if log_format == "json":
+        setup_logging(log_format)
+        ctx.call_on_close(stop_logging)
+    if profile_modes:
+        profiler = ctx.obj = Profiler(profile_dir, profile_modes)
+        profiler.start()
+        ctx.call_on_close(profiler.stop)
+
+
+@main.command(
     help=about.__description__,
+    short_help="Download titles and chapters, used when no command is given",
     epilog=EPILOG,
 )
 @click.version_option(
@@ -98,7 +301,7 @@ Examples:
     metavar="<directory>",
     default="mloader_downloads",
     show_default=True,
-    help="Save directory (not a file)",
+    help="Save directory (not a file), or an s3://bucket/prefix url",
     envvar="MLOADER_EXTRACT_OUT_DIR",
 )
 @click.option(
@@ -110,6 +313,40 @@ Examples:
     help="Save raw images",
     envvar="MLOADER_RAW",
 )
+@click.option(
+    "--format",
+    "-f",
+    "formats",
+    metavar="<formats>",
+    callback=validate_formats,
+    help="Comma separated output formats saved from a single download: "
+    f"{', '.join(EXPORTERS)}  [default: cbz]",
+    envvar="MLOADER_FORMAT",
+)
+@click.option(
+    "--stream-to",
+    type=click.Path(dir_okay=False, allow_dash=True),
+    metavar="<file>",
+    default="-",
+    show_default=True,
+    help="Where the tar and zip formats write their archive, e.g. a named "
+    "pipe. - is stdout, logs then go to stderr",
+    envvar="MLOADER_STREAM_TO",
+)
+@click.option(
+    "--s3-endpoint-url",
+    metavar="<url>",
+    help="Endpoint of an S3 compatible storage used with s3:// urls, "
+    "e.g. http://localhost:9000",
+    envvar="MLOADER_S3_ENDPOINT_URL",
+)
+@click.option(
+    "--dedupe",
+    type=click.Choice(LINK_MODES),
+    help="Link raw pages identical to an already saved page instead of "
+    "writing a copy, and report duplicates inside cbz archives",
+    envvar="MLOADER_DEDUPE",
+)
 @click.option(
     "--quality",
     "-q",
@@ -119,6 +356,30 @@ Examples:
     help="Image quality",
     envvar="MLOADER_QUALITY",
 )
+@click.option(
+    "--deadline",
+    type=click.FloatRange(min=0),
+    metavar="<minutes>",
+    help="Fall back to lower image quality when the remaining chapters "
+    "can't be downloaded in time at the measured throughput",
+    envvar="MLOADER_DEADLINE",
+)
+@click.option(
+    "--max-download-size",
+    type=click.IntRange(min=1),
+    metavar="<MiB>",
+    help="Fall back to lower image quality to keep the total download "
+    "below this size",
+    envvar="MLOADER_MAX_DOWNLOAD_SIZE",
+)
+@click.option(
+    "--quality-report",
+    type=click.Path(dir_okay=False, writable=True),
+    metavar="<file>",
+    help="JSON file recording the quality every chapter was downloaded in, "
+    "merged with the existing content",
+    envvar="MLOADER_QUALITY_REPORT",
+)
 @click.option(
     "--split",
     "-s",
@@ -128,6 +389,177 @@ Examples:
     help="Split combined images",
     envvar="MLOADER_SPLIT",
 )
+@click.option(
+    "--local-split",
+    type=click.Choice(transform.SPLIT_MODES),
+    help="Split double pages locally instead of asking the server. "
+    "'both' keeps the combined page next to the halves",
+    envvar="MLOADER_LOCAL_SPLIT",
+)
+@click.option(
+    "--image-format",
+    type=click.Choice(list(transform.IMAGE_FORMATS)),
+    help="Re-encode downloaded images to this format",
+    envvar="MLOADER_IMAGE_FORMAT",
+)
+@click.option(
+    "--image-quality",
+    type=click.IntRange(min=1, max=100),
+    default=80,
+    show_default=True,
+    help="Quality used when re-encoding images",
+    envvar="MLOADER_IMAGE_QUALITY",
+)
+@click.option(
+    "--max-image-size",
+    type=click.IntRange(min=1),
+    metavar="<pixels>",
+    help="Downscale images so neither side exceeds this size",
+    envvar="MLOADER_MAX_IMAGE_SIZE",
+)
+@click.option(
+    "--verify/--no-verify",
+    default=True,
+    show_default=True,
+    help="Check downloaded images for truncation before saving",
+    envvar="MLOADER_VERIFY",
+)
+@click.option(
+    "--retries",
+    type=click.IntRange(min=1),
+    default=3,
+    show_default=True,
+    help="Download attempts for images that fail verification",
+    envvar="MLOADER_RETRIES",
+)
+@click.option(
+    "--workers",
+    "-w",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Number of pages downloaded in parallel",
+    envvar="MLOADER_WORKERS",
+)
+@click.option(
+    "--adaptive",
+    is_flag=True,
+    default=False,
+    help="Adjust the number of parallel downloads to the measured "
+    "throughput and latency, up to --workers",
+    envvar="MLOADER_ADAPTIVE",
+)
+@click.option(
+    "--max-buffer-size",
+    type=click.IntRange(min=1),
+    default=128,
+    show_default=True,
+    metavar="<MiB>",
+    help="Memory limit for downloaded pages waiting to be saved",
+    envvar="MLOADER_MAX_BUFFER_SIZE",
+)
+@click.option(
+    "--prefetch",
+    type=click.IntRange(min=0),
+    default=2,
+    show_default=True,
+    help="Number of upcoming chapters whose metadata is loaded in advance",
+    envvar="MLOADER_PREFETCH",
+)
+@click.option(
+    "--schedule",
+    type=click.Choice(SCHEDULES),
+    default="title",
+    show_default=True,
+    help="Chapter order: one title after another, or the newest chapter of "
+    "every title first, then the titles in turns",
+    envvar="MLOADER_SCHEDULE",
+)
+@click.option(
+    "--hedge",
+    "hedge_percentile",
+    type=click.FloatRange(min=50, max=100, max_open=True),
+    metavar="<percentile>",
+    help="Send a duplicate request for pages slower than this running "
+    "latency percentile, e.g. 95",
+    envvar="MLOADER_HEDGE",
+)
+@click.option(
+    "--hedge-max-ratio",
+    type=click.FloatRange(min=0, max=1),
+    default=0.05,
+    show_default=True,
+    help="Maximum share of page requests that may be duplicated",
+    envvar="MLOADER_HEDGE_MAX_RATIO",
+)
+@click.option(
+    "--progress",
+    type=click.Choice(PROGRESS_MODES),
+    default="auto",
+    show_default=True,
+    help="Progress output: redrawn summary on a terminal, periodic JSON "
+    "status lines otherwise, or nothing",
+    envvar="MLOADER_PROGRESS",
+)
+@click.option(
+    "--cache-dir",
+    type=click.Path(file_okay=False, writable=True),
+    metavar="<directory>",
+    help="Keep title metadata here and revalidate it with conditional "
+    "requests instead of downloading it again",
+    envvar="MLOADER_CACHE_DIR",
+)
+@click.option(
+    "--state-file",
+    type=click.Path(dir_okay=False, writable=True),
+    metavar="<file>",
+    help="Save the remaining work here when interrupted, the next run with "
+    "the same arguments continues from it",
+    envvar="MLOADER_STATE_FILE",
+)
+@click.option(
+    "--drain-timeout",
+    type=click.FloatRange(min=0),
+    default=20,
+    show_default=True,
+    metavar="<seconds>",
+    help="Time given to running downloads to finish on SIGTERM or Ctrl-C",
+    envvar="MLOADER_DRAIN_TIMEOUT",
+)
+@click.option(
+    "--trace",
+    type=click.Path(dir_okay=False, writable=True),
+    metavar="<file>",
+    help="Record requests, downloads and exports in Chrome trace format, "
+    "viewable in chrome://tracing or Perfetto",
+    envvar="MLOADER_TRACE",
+)
+@click.option(
+    "--record",
+    type=click.Path(file_okay=False, writable=True),
+    metavar="<directory>",
+    help="Save all http responses to replay the run offline",
+)
+@click.option(
+    "--replay",
+    type=click.Path(exists=True, file_okay=False, readable=True),
+    metavar="<directory>",
+    help="Serve http responses saved with --record instead of the network",
+)
+@click.option(
+    "--replay-latency",
+    type=click.FloatRange(min=0),
+    default=0,
+    show_default=True,
+    metavar="<ms>",
+    help="Simulated latency of replayed responses",
+)
+@click.option(
+    "--replay-bandwidth",
+    type=click.FloatRange(min=0, min_open=True),
+    metavar="<MiB/s>",
+    help="Simulated bandwidth of each replayed response",
+)
 @click.option(
     "--chapter",
     "-c",
@@ -184,12 +616,41 @@ Examples:
 )
 @click.argument("urls", nargs=-1, callback=validate_urls, expose_value=False)
 @click.pass_context
-def main(
+def download(
     ctx: click.Context,
     out_dir: str,
     raw: bool,
+    formats: List[str],
+    stream_to: str,
+    s3_endpoint_url: Optional[str],
+    dedupe: Optional[str],
     quality: str,
+    deadline: Optional[float],
+    max_download_size: Optional[int],
+    quality_report: Optional[str],
     split: bool,
+    local_split: Optional[str],
+    image_format: Optional[str],
+    image_quality: int,
+    max_image_size: Optional[int],
+    verify: bool,
+    retries: int,
+    workers: int,
+    adaptive: bool,
+    max_buffer_size: int,
+    prefetch: int,
+    schedule: str,
+    hedge_percentile: Optional[float],
+    hedge_max_ratio: float,
+    progress: str,
+    cache_dir: Optional[str],
+    state_file: Optional[str],
+    drain_timeout: float,
+    trace: Optional[str],
+    record: Optional[str],
+    replay: Optional[str],
+    replay_latency: float,
+    replay_bandwidth: Optional[float],
     begin: int,
     end: int,
     last: bool,
@@ -198,22 +659,128 @@ def main(
     chapters: Optional[Set[int]] = None,
     titles: Optional[Set[int]] = None,
 ):
-    click.echo(click.style(about.__doc__, fg="blue"))
+    log_format = ctx.find_root().params.get("log_format", "text")
+    streams = [f for f in formats if f in STREAM_FORMATS]
+    to_stdout = bool(streams) and stream_to == "-"
+    if to_stdout:
+        # stdout carries the archive, everything else goes to stderr
+        setup_logging(log_format, sys.stderr)
+    # Keeps stdout parseable when logging JSON lines
+    if log_format != "json":
+        click.echo(click.style(about.__doc__, fg="blue"), err=to_stdout)
     if not any((chapters, titles)):
         click.echo(ctx.get_help())
         return
+    if split and local_split:
+        raise click.UsageError("--split and --local-split are exclusive")
+    if (
+        any((local_split, image_format, max_image_size))
+        and not transform.is_available()
+    ):
+        raise click.UsageError(
+            "Image processing requires Pillow, "
+            "install it with `pip install mloader[images]`"
+        )
+    if record and replay:
+        raise click.UsageError("--record and --replay are exclusive")
+    if len(streams) > 1:
+        raise click.UsageError("Only one of tar and zip can be streamed")
+    if s3.is_s3_url(out_dir) and "sqlite" in formats:
+        raise click.UsageError("The sqlite format can't be saved to S3")
+    if s3.is_s3_url(out_dir) and dedupe:
+        raise click.UsageError("--dedupe can't be used with S3")
+    if s3.is_s3_url(out_dir) and not s3.is_available():
+        raise click.UsageError(
+            "S3 export requires boto3, install it with `pip install mloader[s3]`"
+        )
     end = end or float("inf")
     log.info("Started export")
 
-    exporter = RawExporter if raw else CBZExporter
-    exporter = partial(
-        exporter,
-        destination=out_dir,
-        add_chapter_title=chapter_title,
-        add_chapter_subdir=chapter_subdir,
-    )
+    if raw and "raw" not in formats:
+        formats.append("raw")
+    formats = formats or ["cbz"]
+    stream = ArchiveStream(stream_to, streams[0]) if streams else None
+    store = None
+    if "sqlite" in formats:
+        store = BlobStore(os.path.join(out_dir, "library.sqlite3"))
+    deduplicator = Deduplicator(out_dir, dedupe) if dedupe else None
+    storage = None
+    manifest = writer = None
+    tracer = Tracer(enabled=bool(trace))
+    if s3.is_s3_url(out_dir):
+        storage = s3.S3Storage(out_dir, s3_endpoint_url, workers=workers * 2)
+    elif "cbz" in formats:
+        manifest = LibraryManifest(out_dir)
+        writer = ArchiveWriter(tracer=tracer)
+    exporters = []
+    for f in formats:
+        factory, options = EXPORTERS[f], {}
+        if f in STREAM_FORMATS:
+            options["stream"] = stream
+        elif f == "sqlite":
+            options["store"] = store
+        elif storage:
+            factory, options["storage"] = S3_EXPORTERS[f], storage
+        elif f == "cbz":
+            options.update(
+                dedupe=deduplicator, manifest=manifest, writer=writer
+            )
+        else:
+            options["dedupe"] = deduplicator
+        exporters.append(
+            partial(
+                factory,
+                destination=out_dir,
+                add_chapter_title=chapter_title,
+                add_chapter_subdir=chapter_subdir,
+                **options,
+            )
+        )
 
-    loader = MangaLoader(exporter, quality, split)
+    if replay:
+        transport = ReplayTransport(
+            replay,
+            latency=replay_latency / 1000,
+            bandwidth=replay_bandwidth and replay_bandwidth * 1024 * 1024,
+        )
+    else:
+        transport = LiveTransport(pool_size=workers)
+        if record:
+            transport = RecordingTransport(transport, record)
+
+    loader = MangaLoader(
+        exporters,
+        quality,
+        split,
+        deadline=deadline * 60 if deadline else None,
+        max_download_size=(
+            max_download_size * 1024 * 1024 if max_download_size else None
+        ),
+        quality_report=quality_report,
+        local_split=local_split,
+        image_format=image_format,
+        image_quality=image_quality,
+        max_image_size=max_image_size,
+        verify=verify,
+        retries=retries,
+        workers=workers,
+        adaptive=adaptive,
+        max_buffer_size=max_buffer_size * 1024 * 1024,
+        prefetch=prefetch,
+        schedule=schedule,
+        hedge_percentile=hedge_percentile,
+        hedge_max_ratio=hedge_max_ratio,
+        progress=progress,
+        progress_stream=sys.stderr if to_stdout else sys.stdout,
+        cache_dir=cache_dir,
+        state_file=state_file,
+        drain_timeout=drain_timeout,
+        trace=trace,
+        profiler=ctx.find_object(Profiler),
+        tracer=tracer,
+        transport=transport,
+    )
+    received = handle_stop_signals(loader)
     try:
         loader.download(
             title_ids=titles,
@@ -224,8 +791,95 @@ def main(
         )
     except Exception:
         log.exception("Failed to download manga")
+    finally:
+        if writer:
+            try:
+                writer.close()
+            except Exception:
+                log.exception("Failed to write archives")
+        if stream:
+            stream.close()
+        if storage:
+            storage.close()
+        if store:
+            store.close()
+        if deduplicator:
+            deduplicator.close()
+        if manifest:
+            manifest.save()
+    if received:
+        log.info("Stopped by %s", signal.Signals(received[0]).name)
+        ctx.exit(128 + received[0])
     log.info("SUCCESS")
 
 
+@main.command(help="Check downloaded images and archives for corruption")
+@click.argument(
+    "directory", type=click.Path(exists=True, file_okay=False, readable=True)
+)
+@click.option(
+    "--workers",
+    "-w",
+    type=click.IntRange(min=1),
+    help="Number of worker processes  [default: number of CPUs]",
+)
+@click.pass_context
+def verify(ctx: click.Context, directory: str, workers: Optional[int]):
+    checked = corrupt = 0
+    for path, problems in scan_library(directory, workers):
+        checked += 1
+        if problems:
+            corrupt += 1
+            for problem in problems:
+                click.echo(f"{path}: {problem}")
+    log.info("Checked %s files, %s corrupt", checked, corrupt)
+    if corrupt:
+        ctx.exit(1)
+
+
+@main.command(help="Replace duplicate pages in a library with links")
+@click.argument(
+    "directory", type=click.Path(exists=True, file_okay=False, writable=True)
+)
+@click.option(
+    "--link",
+    "mode",
+    type=click.Choice(LINK_MODES),
+    default="hardlink",
+    show_default=True,
+    help="How duplicates are linked to the first copy",
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="Only list the duplicates",
+)
+def dedupe(directory: str, mode: str, dry_run: bool):
+    # Also indexes the library for `download --dedupe`
+    deduplicator = Deduplicator(directory, mode)
+    paths = (
+        path
+        for path in find_library_files(directory)
+        if path.suffix.lower() in IMAGE_EXTENSIONS
+    )
+    count = size = 0
+    try:
+        for path, original in dedupe_library(deduplicator, paths, dry_run):
+            count += 1
+            size += original.stat().st_size
+            if dry_run:
+                click.echo(f"{path} -> {original}")
+    finally:
+        deduplicator.close()
+    log.info(
+        "%s %s duplicate pages, %.1f MiB",
+        "Found" if dry_run else "Linked",
+        count,
+        size / 1024 / 1024,
+    )
+
+
 if __name__ == "__main__":
     main(prog_name=about.__title__)
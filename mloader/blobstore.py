@@ -0,0 +1,154 @@
+import sqlite3
+from collections import namedtuple
+from pathlib import Path
+from threading import Lock
+from typing import List, Optional, Union
+
+from mloader.exporter import ExporterBase
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chapters (
+    chapter_id INTEGER PRIMARY KEY,
+    title_id INTEGER NOT NULL,
+    title_name TEXT NOT NULL,
+    chapter_name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chapters_title ON chapters (title_id);
+CREATE TABLE IF NOT EXISTS pages (
+    chapter_id INTEGER NOT NULL,
+    first_page INTEGER NOT NULL,
+    last_page INTEGER NOT NULL,
+    ext TEXT NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS pages_key
+    ON pages (chapter_id, first_page, last_page, ext);
+"""
+
+
+ChapterInfo = namedtuple(
+    "ChapterInfo", "chapter_id title_id title_name chapter_name"
+)
+PageInfo = namedtuple("PageInfo", "first_page last_page ext size")
+
+
+def _page_range(index: Union[int, range]):
+    # Double pages are stored under both page numbers they cover
+    if isinstance(index, range):
+        return index.start, index.stop
+    return index, index
+
+
+class BlobStore:
+    # Pages of a whole library in one SQLite file. Writes are grouped in one
+    # transaction per chapter. The read methods are meant for serving pages
+    # straight from the database.
+    def __init__(self, path: str, readonly: bool = False):
+        self.path = Path(path)
+        if readonly:
+            uri = f"{self.path.resolve().as_uri()}?mode=ro"
+            self._db = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(SCHEMA)
+        self._lock = Lock()
+
+    def add_chapter(self, chapter: ChapterInfo):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO chapters VALUES (?, ?, ?, ?)", chapter
+            )
+
+    def add_page(
+        self, chapter_id: int, index: Union[int, range], ext: str, data: bytes
+    ):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)",
+                (chapter_id, *_page_range(index), ext, bytes(data)),
+            )
+
+    def has_page(
+        self, chapter_id: int, index: Union[int, range], ext: str
+    ) -> bool:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM pages WHERE chapter_id = ? AND first_page = ? "
+                "AND last_page = ? AND ext = ?",
+                (chapter_id, *_page_range(index), ext),
+            ).fetchone()
+        return row is not None
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+
+    def chapters(self, title_id: Optional[int] = None) -> List[ChapterInfo]:
+        query = "SELECT * FROM chapters"
+        params = ()
+        if title_id is not None:
+            query += " WHERE title_id = ?"
+            params = (title_id,)
+        with self._lock:
+            rows = self._db.execute(f"{query} ORDER BY chapter_id", params)
+            return [ChapterInfo(*row) for row in rows]
+
+    def pages(self, chapter_id: int) -> List[PageInfo]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT first_page, last_page, ext, length(data) FROM pages "
+                "WHERE chapter_id = ? ORDER BY first_page, last_page, ext",
+                (chapter_id,),
+            )
+            return [PageInfo(*row) for row in rows]
+
+    def read_page(
+        self, chapter_id: int, page: int, ext: Optional[str] = None
+    ) -> Optional[bytes]:
+        # Single pages are preferred over the double page containing `page`
+        query = (
+            "SELECT data FROM pages WHERE chapter_id = ? "
+            "AND first_page <= ? AND last_page >= ?"
+        )
+        params = [chapter_id, page, page]
+        if ext is not None:
+            query += " AND ext = ?"
+            params.append(ext)
+        query += " ORDER BY last_page - first_page LIMIT 1"
+        with self._lock:
+            row = self._db.execute(query, params).fetchone()
+        return row and row[0]
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+
+class BlobStoreExporter(ExporterBase):
+    # Saves pages into a BlobStore shared by all chapters of a run, instead
+    # of a file per page like RawExporter
+    def __init__(self, *args, store: BlobStore, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.store = store
+        self.store.add_chapter(
+            ChapterInfo(
+                self.chapter_id,
+                self.title_id,
+                self.title_name,
+                self.chapter_name,
+            )
+        )
+
+    def add_image(
+        self, image_data: bytes, index: Union[int, range], ext: str = ".jpg"
+    ):
+        self.store.add_page(self.chapter_id, index, ext, image_data)
+
+    def skip_image(self, index: Union[int, range], ext: str = ".jpg") -> bool:
+        return self.store.has_page(self.chapter_id, index, ext)
+
+    def close(self):
+        self.store.commit()
@@ -0,0 +1,52 @@
+import json
+import os
+from collections import namedtuple
+from pathlib import Path
+from typing import Dict, Optional
+
+from mloader.utils import request_key
+
+CacheEntry = namedtuple("CacheEntry", "content etag last_modified")
+
+
+class MetadataCache:
+    # Stores raw API responses together with their HTTP validators (ETag,
+    # Last-Modified), so they can be revalidated with conditional requests
+    def __init__(self, directory: str):
+        self.path = Path(directory)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def get(self, url: str, params: Dict) -> Optional[CacheEntry]:
+        key = request_key(url, params)
+        try:
+            meta = json.loads(self.path.joinpath(f"{key}.json").read_text())
+            content = self.path.joinpath(f"{key}.bin").read_bytes()
+        except (OSError, ValueError):
+            return None
+        return CacheEntry(content, meta.get("etag"), meta.get("last_modified"))
+
+    def set(self, url: str, params: Dict, entry: CacheEntry):
+        key = request_key(url, params)
+        meta = {
+            "url": url,
+            "params": params,
+            "etag": entry.etag,
+            "last_modified": entry.last_modified,
+        }
+        # The content is replaced first so validators never describe stale data
+        self._write(f"{key}.bin", entry.content)
+        self._write(f"{key}.json", json.dumps(meta, default=str).encode())
+
+    def _write(self, name: str, data: bytes):
+        tmp = self.path.joinpath(f"{name}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, self.path.joinpath(name))
+
+    @staticmethod
+    def conditional_headers(entry: Optional[CacheEntry]) -> Dict[str, str]:
+        headers = {}
+        if entry and entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry and entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+        return headers
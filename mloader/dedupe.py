@@ -0,0 +1,197 @@
+import hashlib
+import logging
+import os
+import sqlite3
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Iterable, Iterator, Optional, Set, Tuple
+
+from mloader.utils import file_digest
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+log = logging.getLogger()
+
+LINK_MODES = ("hardlink", "reflink")
+INDEX_NAME = "dedupe.sqlite3"
+# ioctl request cloning a whole file on Linux (btrfs, xfs)
+FICLONE = 0x40049409
+
+# Pages only seen inside an archive have no path
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    path TEXT,
+    archived INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+def page_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def link_file(source: Path, target: Path, mode: str = "hardlink"):
+    if mode == "hardlink":
+        os.link(source, target)
+        return
+    if fcntl is None:
+        raise OSError("Reflinks aren't supported on this platform")
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            target.unlink()
+            raise
+
+
+def _same_content(path: Path, data: bytes) -> bool:
+    # Guards against files changed or removed since they were indexed
+    try:
+        return path.stat().st_size == len(data) and path.read_bytes() == data
+    except OSError:
+        return False
+
+
+class Deduplicator:
+    # Content hashes of pages saved to a library, kept in `INDEX_NAME` at its
+    # root. Pages identical to an already saved file are linked to it
+    # instead of written again. Paths are stored relative to the root, so
+    # the library can be moved.
+    def __init__(self, root: str, mode: str = "hardlink"):
+        if mode not in LINK_MODES:
+            raise ValueError(f"Unknown link mode: {mode}")
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.mode = mode
+        self._db = sqlite3.connect(
+            str(self.root.joinpath(INDEX_NAME)), check_same_thread=False
+        )
+        self._db.executescript(SCHEMA)
+        self._lock = Lock()
+        self.linked = 0
+        self.archived = 0
+        self.saved_bytes = 0
+
+    def _find(self, digest: str) -> Optional[Tuple[Optional[str], int]]:
+        with self._lock:
+            return self._db.execute(
+                "SELECT path, archived FROM pages WHERE digest = ?", (digest,)
+            ).fetchone()
+
+    def _relative(self, path: Path) -> str:
+        return Path(os.path.relpath(path, self.root)).as_posix()
+
+    def add(self, digest: str, size: int, path: Optional[Path] = None):
+        # A page first seen in an archive gets the path of the first file
+        # it is saved to
+        relative = path and self._relative(path)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR IGNORE INTO pages (digest, size, path) "
+                "VALUES (?, ?, ?)",
+                (digest, size, relative),
+            )
+            if relative:
+                self._db.execute(
+                    "UPDATE pages SET path = ? "
+                    "WHERE digest = ? AND path IS NULL",
+                    (relative, digest),
+                )
+
+    def _forget(self, digest: str):
+        with self._lock:
+            self._db.execute(
+                "UPDATE pages SET path = NULL WHERE digest = ?", (digest,)
+            )
+
+    def link(self, digest: str, data: bytes, target: Path) -> bool:
+        # Creates `target` as a link to a saved copy of `data`, False when
+        # there is none or it can't be linked
+        row = self._find(digest)
+        if not row or not row[0]:
+            return False
+        source = self.root.joinpath(row[0])
+        if not _same_content(source, data):
+            self._forget(digest)
+            return False
+        try:
+            if os.path.lexists(target):
+                target.unlink()
+            link_file(source, target, self.mode)
+        except OSError as e:
+            log.debug("Can't link %s to %s: %s", target, source, e)
+            return False
+        with self._lock:
+            self.linked += 1
+            self.saved_bytes += len(data)
+        return True
+
+    def seen(self, digest: str, size: int) -> bool:
+        # Records a page saved inside an archive, which can't be linked.
+        # Returns whether the same page is already inside an archive.
+        row = self._find(digest)
+        if row and row[1]:
+            with self._lock:
+                self.archived += 1
+            return True
+        self.add(digest, size)
+        with self._lock:
+            self._db.execute(
+                "UPDATE pages SET archived = 1 WHERE digest = ?", (digest,)
+            )
+        return False
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+
+    def close(self):
+        if self.linked or self.archived:
+            log.info(
+                "Duplicate pages: %s linked, saving %.1f MiB, "
+                "%s inside archives",
+                self.linked,
+                self.saved_bytes / 1024 / 1024,
+                self.archived,
+            )
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+
+def dedupe_library(
+    dedupe: Deduplicator, paths: Iterable[Path], dry_run: bool = False
+) -> Iterator[Tuple[Path, Path]]:
+    # Replaces files with a link to the first file of the same content,
+    # yielding (duplicate, original) pairs. Files that are already links of
+    # each other are hashed once.
+    originals: Dict[str, Path] = {}
+    inodes: Set[Tuple[int, int]] = set()
+    for path in paths:
+        stat = path.stat()
+        if (stat.st_dev, stat.st_ino) in inodes:
+            continue
+        inodes.add((stat.st_dev, stat.st_ino))
+        digest = file_digest(path)
+        original = originals.setdefault(digest, path)
+        if original is path:
+            if not dry_run:
+                dedupe.add(digest, stat.st_size, path)
+            continue
+        if not dry_run:
+            tmp = path.with_name(f"{path.name}.part")
+            try:
+                if os.path.lexists(tmp):
+                    tmp.unlink()
+                link_file(original, tmp, dedupe.mode)
+            except OSError as e:
+                log.warning("Can't link %s to %s: %s", path, original, e)
+                continue
+            os.replace(tmp, path)
+        yield path, original
@@ -1,11 +1,23 @@
+import logging
+import os
+import queue
+import sys
+import tarfile
+import time
 import zipfile
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import Future
 from itertools import chain
 from pathlib import Path
-from typing import Union, Optional
+from io import BytesIO
+from threading import BoundedSemaphore, Lock, Thread
+from typing import BinaryIO, Callable, List, Union, Optional
 
 from mloader.constants import Language
+from mloader.dedupe import Deduplicator, page_digest
+from mloader.manifest import LibraryManifest
 from mloader.response_pb2 import Title, Chapter
+from mloader.trace import Tracer
 from mloader.utils import (
     escape_path,
     is_oneshot,
@@ -13,6 +25,21 @@ from mloader.utils import (
     is_windows,
 )
 
+log = logging.getLogger()
+
+# Archive entries get fixed metadata instead of the current time, so the
+# same pages always give a byte identical archive
+ARCHIVE_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def archive_entry(name: str, compression: int) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(name, date_time=ARCHIVE_DATE_TIME)
+    info.compress_type = compression
+    # Same on every platform
+    info.create_system = 3
+    info.external_attr = 0o644 << 16
+    return info
+
 
 class ExporterBase(metaclass=ABCMeta):
     def __init__(
@@ -32,6 +59,8 @@ class ExporterBase(metaclass=ABCMeta):
 
         self.add_chapter_title = add_chapter_title
         self.add_chapter_subdir = add_chapter_subdir
+        self.title_id = title.title_id
+        self.chapter_id = chapter.chapter_id
         self.title_name = escape_path(title.name).title()
         self.is_oneshot = is_oneshot(chapter.name, chapter.sub_title)
         self.is_extra = self._is_extra(chapter.name)
@@ -108,55 +137,335 @@ class ExporterBase(metaclass=ABCMeta):
     def close(self):
         pass
 
+    def checkpoint(self):
+        # Called instead of close() when a run is interrupted mid-chapter,
+        # keeping what was written so far for the next run
+        self.close()
+
+    def saved(self) -> Future:
+        # Resolves once the chapter is saved, exporters writing in the
+        # background may still be busy when close() returns
+        future = Future()
+        future.set_result(None)
+        return future
+
     @abstractmethod
-    def add_image(self, image_data: bytes, index: Union[int, range]):
+    def add_image(
+        self, image_data: bytes, index: Union[int, range], ext: str = ".jpg"
+    ):
         pass
 
     @abstractmethod
-    def skip_image(self, index: Union[int, range]) -> bool:
+    def skip_image(self, index: Union[int, range], ext: str = ".jpg") -> bool:
         pass
 
 
 class RawExporter(ExporterBase):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, dedupe: Optional[Deduplicator] = None, **kwargs):
         super().__init__(*args, **kwargs)
+        self.dedupe = dedupe
         self.path = Path(self.destination, self.title_name)
         self.path.mkdir(parents=True, exist_ok=True)
         if self.add_chapter_subdir:
             self.path = self.path.joinpath(self.chapter_name)
             self.path.mkdir(parents=True, exist_ok=True)
 
-    def add_image(self, image_data: bytes, index: Union[int, range]):
-        filename = Path(self.format_page_name(index))
-        self.path.joinpath(filename).write_bytes(image_data)
+    def add_image(
+        self, image_data: bytes, index: Union[int, range], ext: str = ".jpg"
+    ):
+        filename = Path(self.format_page_name(index, ext))
+        # Written under a temporary name, so an interrupted write doesn't
+        # leave a truncated page that would be skipped next time
+        tmp = self.path.joinpath(f"{filename}.part")
+        digest = self.dedupe and page_digest(image_data)
+        if not digest or not self.dedupe.link(digest, image_data, tmp):
+            tmp.write_bytes(image_data)
+        os.replace(tmp, self.path.joinpath(filename))
+        if digest:
+            self.dedupe.add(digest, len(image_data), self.path / filename)
 
-    def skip_image(self, index: Union[int, range]) -> bool:
-        filename = Path(self.format_page_name(index))
+    def skip_image(self, index: Union[int, range], ext: str = ".jpg") -> bool:
+        filename = Path(self.format_page_name(index, ext))
         return self.path.joinpath(filename).exists()
 
+    def close(self):
+        if self.dedupe:
+            self.dedupe.commit()
+
+
+class ArchiveTasks:
+    # Runs the writes of one archive in order on its own thread. Callers
+    # block once `queue_size` writes are waiting. After a failure the
+    # remaining writes are dropped. `done` resolves, with the error if any,
+    # once all writes have run.
+    def __init__(self, name: str, queue_size: int, on_exit: Callable):
+        self.name = name
+        self.error: Optional[Exception] = None
+        self.finished = False
+        self.done = Future()
+        self._queue = queue.Queue(queue_size)
+        self._on_exit = on_exit
+        self.thread = Thread(target=self._run, name="cbz-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, fn: Callable, *args):
+        if self.error is None:
+            self._queue.put((fn, args))
+
+    def finish(self):
+        if not self.finished:
+            self.finished = True
+            self._queue.put(None)
+
+    def _run(self):
+        try:
+            while True:
+                task = self._queue.get()
+                if task is None:
+                    return
+                if self.error is not None:
+                    continue
+                fn, args = task
+                try:
+                    fn(*args)
+                except Exception as e:
+                    self.error = e
+        finally:
+            if self.error is None:
+                self.done.set_result(None)
+            else:
+                self.done.set_exception(self.error)
+            self._on_exit()
+
+
+class ArchiveWriter:
+    # Compresses and finalizes CBZ archives on background threads, so the
+    # next chapter downloads while the previous one is written. Opening an
+    # archive waits while `max_archives` are still being written.
+    def __init__(
+        self,
+        queue_size: int = 32,
+        max_archives: int = 2,
+        tracer: Optional[Tracer] = None,
+    ):
+        self.queue_size = queue_size
+        self.tracer = tracer or Tracer()
+        self._slots = BoundedSemaphore(max_archives)
+        self._tasks: List[ArchiveTasks] = []
+        self._lock = Lock()
+
+    def open(self, name: str) -> ArchiveTasks:
+        self._slots.acquire()
+        tasks = ArchiveTasks(name, self.queue_size, self._slots.release)
+        with self._lock:
+            # Failed archives are kept for close() to report
+            self._tasks = [
+                t for t in self._tasks if t.thread.is_alive() or t.error
+            ]
+            self._tasks.append(tasks)
+        return tasks
+
+    def close(self):
+        # Waits for all archives, ones that were never closed stay .part.
+        # The first error of any archive is raised.
+        with self._lock:
+            pending, self._tasks = self._tasks, []
+        for tasks in pending:
+            tasks.finish()
+            tasks.thread.join()
+        failed = [tasks for tasks in pending if tasks.error is not None]
+        for tasks in failed:
+            log.error("Failed to write %s: %s", tasks.name, tasks.error)
+        if failed:
+            raise failed[0].error
+
 
 class CBZExporter(ExporterBase):
-    def __init__(self, compression=zipfile.ZIP_DEFLATED, *args, **kwargs):
+    def __init__(
+        self,
+        compression=zipfile.ZIP_DEFLATED,
+        *args,
+        dedupe: Optional[Deduplicator] = None,
+        manifest: Optional[LibraryManifest] = None,
+        writer: Optional[ArchiveWriter] = None,
+        **kwargs,
+    ):
         super().__init__(*args, **kwargs)
+        # Pages can't be linked inside an archive, duplicates are reported
+        self.dedupe = dedupe
+        self.duplicates = 0
+        self.manifest = manifest
+        self.compression = compression
         self.path = Path(self.destination, self.title_name)
         self.path.mkdir(parents=True, exist_ok=True)
         self.path = self.path.joinpath(self.chapter_name).with_suffix(".cbz")
-        self.skip_all_images = self.path.exists()
+        # The archive only gets its final name once it is complete
+        self.part_path = self.path.with_name(f"{self.path.name}.part")
+        self.skip_all_images = self.path.exists() and not self._is_changed()
+        self._written = set()
+        self._tasks: Optional[ArchiveTasks] = None
+        # Writes on the writer threads are traced here, others by the caller
+        self.tracer = writer.tracer if writer else Tracer()
         if not self.skip_all_images:
-            self.archive = zipfile.ZipFile(
-                self.path, mode="w", compression=compression
-            )
+            self.archive = self._open_archive(compression)
+            if writer:
+                self._tasks = writer.open(str(self.path))
+
+    def _is_changed(self) -> bool:
+        # Archives that differ from the checksum in the manifest are saved
+        # again, unchanged ones are skipped before anything is written
+        unchanged = self.manifest and self.manifest.is_unchanged(self.path)
+        if unchanged is not False:
+            return False
+        log.warning("%s changed since it was saved, replacing it", self.path)
+        return True
 
-    def add_image(self, image_data: bytes, index: Union[int, range]):
+    def _open_archive(self, compression: int) -> zipfile.ZipFile:
+        # Pages checkpointed by an interrupted run are kept
+        try:
+            with zipfile.ZipFile(self.part_path) as archive:
+                self._written = set(archive.namelist())
+            mode = "a"
+        except (OSError, zipfile.BadZipFile):
+            mode = "w"
+        return zipfile.ZipFile(
+            self.part_path, mode=mode, compression=compression
+        )
+
+    def _archive_name(self, index: Union[int, range], ext: str) -> str:
+        path = Path(self.chapter_name, self.format_page_name(index, ext))
+        return path.as_posix()
+
+    def add_image(
+        self, image_data: bytes, index: Union[int, range], ext: str = ".jpg"
+    ):
         if self.skip_all_images:
             return
-        path = Path(self.chapter_name, self.format_page_name(index))
-        self.archive.writestr(path.as_posix(), image_data)
+        name = self._archive_name(index, ext)
+        self._written.add(name)
+        if self._tasks is None:
+            self._write_page(name, image_data)
+        else:
+            # The caller reuses the page buffer once this returns
+            self._tasks.submit(self._write_page, name, bytes(image_data))
+
+    def _write_page(self, name: str, image_data: bytes):
+        with self.tracer.span("write page", page=name):
+            self.archive.writestr(
+                archive_entry(name, self.compression), image_data
+            )
+            if self.dedupe and self.dedupe.seen(
+                page_digest(image_data), len(image_data)
+            ):
+                self.duplicates += 1
+
+    def skip_image(self, index: Union[int, range], ext: str = ".jpg") -> bool:
+        return (
+            self.skip_all_images
+            or self._archive_name(index, ext) in self._written
+        )
 
-    def skip_image(self, index: Union[int, range]) -> bool:
-        return self.skip_all_images
+    def _run(self, fn: Callable):
+        if self._tasks is None:
+            fn()
+        else:
+            # Returns right away, the writer finishes the archive
+            self._tasks.submit(fn)
+            self._tasks.finish()
 
     def close(self):
-        if self.skip_all_images:
-            return
-        self.archive.close()
+        if not self.skip_all_images:
+            self._run(self._finish)
+
+    def saved(self) -> Future:
+        if self._tasks is None:
+            return super().saved()
+        return self._tasks.done
+
+    def _finish(self):
+        with self.tracer.span("finish archive", archive=self.path.name):
+            self.archive.close()
+            os.replace(self.part_path, self.path)
+            if self.manifest:
+                self.manifest.add(self.path)
+        if self.dedupe:
+            self.dedupe.commit()
+        if self.duplicates:
+            log.info("%s: %s duplicate pages", self.path, self.duplicates)
+
+    def checkpoint(self):
+        if not self.skip_all_images:
+            self._run(self.archive.close)
+
+
+STREAM_FORMATS = ("tar", "zip")
+
+
+class ArchiveStream:
+    # A tar or zip archive written sequentially to stdout ("-"), a named pipe
+    # or a file, shared by the exporters of all chapters of a run. Nothing
+    # is buffered on disk and no seeking is needed.
+    def __init__(self, target: str, archive_format: str = "tar"):
+        if archive_format not in STREAM_FORMATS:
+            raise ValueError(f"Unknown stream format: {archive_format}")
+        self.target = target
+        if target == "-":
+            self._file: BinaryIO = sys.stdout.buffer
+        else:
+            self._file = open(target, "wb")
+        if archive_format == "tar":
+            self._tar = tarfile.open(fileobj=self._file, mode="w|")
+            self._zip = None
+        else:
+            # Images are already compressed
+            self._zip = zipfile.ZipFile(
+                self._file, mode="w", compression=zipfile.ZIP_STORED
+            )
+            self._tar = None
+        self._lock = Lock()
+
+    def add(self, name: str, data: bytes):
+        with self._lock:
+            if self._tar is not None:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = int(time.time())
+                self._tar.addfile(info, BytesIO(data))
+            else:
+                self._zip.writestr(name, data)
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._tar is not None:
+                self._tar.close()
+            else:
+                self._zip.close()
+            self._file.flush()
+            if self.target != "-":
+                self._file.close()
+
+
+class StreamExporter(ExporterBase):
+    # Writes pages into an ArchiveStream as they arrive, one directory per
+    # chapter. The stream is closed by its owner after the run.
+    def __init__(self, *args, stream: ArchiveStream, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stream = stream
+        self.prefix = Path(self.title_name, self.chapter_name)
+
+    def add_image(
+        self, image_data: bytes, index: Union[int, range], ext: str = ".jpg"
+    ):
+        name = self.prefix.joinpath(self.format_page_name(index, ext))
+        self.stream.add(name.as_posix(), image_data)
+
+    def skip_image(self, index: Union[int, range], ext: str = ".jpg") -> bool:
+        return False
+
+    def close(self):
+        # Consumers get every finished chapter right away
+        self.stream.flush()
@@ -1,14 +1,52 @@
+import json
 import logging
-from collections import namedtuple
-from functools import lru_cache
+import sys
+import time
+from collections import deque, namedtuple
+from concurrent.futures import (
+    CancelledError,
+    Future,
+    ThreadPoolExecutor,
+    TimeoutError as FutureTimeout,
+)
+from functools import partial
 from itertools import chain, count
-from typing import Union, Dict, Set, Collection, Optional, Callable
-
-import click
-from requests import Session
+from threading import Event
+from typing import (
+    Union,
+    Dict,
+    Set,
+    Collection,
+    Optional,
+    Callable,
+    List,
+    Deque,
+    Sequence,
+    TextIO,
+    Tuple,
+)
 
+from mloader.cache import CacheEntry, MetadataCache
 from mloader.constants import PageType
 from mloader.exporter import ExporterBase
+from mloader.metrics import Metrics
+from mloader.plan import PagePlan, TitlePlan, ViewerPlan
+from mloader.pipeline import (
+    AIMDController,
+    BufferPool,
+    ByteBudget,
+    Dispatcher,
+    HedgeTimer,
+    Hedger,
+    Prefetcher,
+    resize_buffer,
+)
+from mloader.profiling import Profiler
+from mloader.progress import create_progress
+from mloader.quality import QualitySelector
+from mloader.schedule import ScheduleItem, create_schedule
+from mloader.state import RunState
+from mloader.trace import Tracer, page_label
 from mloader.response_pb2 import (
     Response,
     MangaViewer,
@@ -16,59 +54,309 @@ from mloader.response_pb2 import (
     Chapter,
     Title,
 )
+from mloader.transform import ImageProcessor
+from mloader.transport import LiveTransport, Transport, raw_body
 from mloader.utils import chapter_name_to_int
+from mloader.verify import CorruptImageError, check_image
 
 log = logging.getLogger()
 
 MangaList = Dict[int, Set[int]]  # Title ID: Set[Chapter ID]
 
 
+# Largest read from the network at a time
+READ_CHUNK_SIZE = 64 * 1024
+# Seconds between checks for a stop request while waiting for a page
+STOP_CHECK_INTERVAL = 0.5
+
+
+class DownloadStopped(Exception):
+    pass
+
+
+ExporterFactory = Callable[[Title, Chapter, Optional[Chapter]], ExporterBase]
+
+
 class MangaLoader:
     def __init__(
         self,
-        exporter: Callable[[Title, Chapter, Optional[Chapter]], ExporterBase],
+        exporter: Union[ExporterFactory, Sequence[ExporterFactory]],
         quality: str = "super_high",
         split: bool = False,
+        local_split: Optional[str] = None,
+        image_format: Optional[str] = None,
+        image_quality: Optional[int] = None,
+        max_image_size: Optional[int] = None,
+        verify: bool = True,
+        retries: int = 3,
+        workers: int = 4,
+        max_buffer_size: int = 128 * 1024 * 1024,
+        progress: str = "silent",
+        cache_dir: Optional[str] = None,
+        transport: Optional[Transport] = None,
+        prefetch: int = 2,
+        hedge_percentile: Optional[float] = None,
+        hedge_max_ratio: float = 0.05,
+        adaptive: bool = False,
+        deadline: Optional[float] = None,
+        max_download_size: Optional[int] = None,
+        quality_report: Optional[str] = None,
+        schedule: str = "title",
+        state_file: Optional[str] = None,
+        drain_timeout: float = 20.0,
+        trace: Optional[str] = None,
+        profiler: Optional[Profiler] = None,
+        tracer: Optional[Tracer] = None,
+        progress_stream: Optional[TextIO] = None,
     ):
-        self.exporter = exporter
+        # Every page is fetched once and handed to all exporters
+        self.exporters = [exporter] if callable(exporter) else list(exporter)
         self.quality = quality
         self.split = split
-        self._api_url = "https://jumpg-webapi.tokyo-cdn.com"
-        self.session = Session()
-        self.session.headers.update(
-            {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; "
-                "rv:72.0) Gecko/20100101 Firefox/72.0"
-            }
+        self.local_split = local_split
+        self.image_format = image_format
+        self.image_quality = image_quality
+        self.max_image_size = max_image_size
+        self.verify = verify
+        self.retries = retries
+        self.workers = workers
+        self.max_buffer_size = max_buffer_size
+        self.prefetch = prefetch
+        self.schedule = schedule
+        self.state = RunState(state_file) if state_file else None
+        self.drain_timeout = drain_timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_max_ratio = hedge_max_ratio
+        self.adaptive = adaptive
+        self.metrics = Metrics()
+        self.trace = trace
+        self.tracer = tracer or Tracer(enabled=bool(trace))
+        self.profiler = profiler
+        self.selector = QualitySelector(
+            quality, self.metrics, deadline, max_download_size
         )
+        self.quality_report = quality_report
+        # Chapter ID: quality it was downloaded in, for later upgrades
+        self.chapter_qualities: Dict[int, Dict] = {}
+        self.progress = create_progress(
+            progress, self.metrics, stream=progress_stream or sys.stdout
+        )
+        self.cache = MetadataCache(cache_dir) if cache_dir else None
+        self.processor: Optional[ImageProcessor] = None
+        self._budget: Optional[ByteBudget] = None
+        self._buffers: Optional[BufferPool] = None
+        self._fetch_pool: Optional[ThreadPoolExecutor] = None
+        self._dispatcher: Optional[Dispatcher] = None
+        self._controller: Optional[AIMDController] = None
+        self._metadata_pool: Optional[ThreadPoolExecutor] = None
+        self._hedge_pool: Optional[ThreadPoolExecutor] = None
+        self._hedger: Optional[Hedger] = None
+        self._viewers: Dict[int, ViewerPlan] = {}
+        self._titles: Dict[int, TitlePlan] = {}
+        self._sequence = count()
+        # Set by stop(), which may run in a signal handler, and acted on
+        # by the download loop
+        self._stop_requested = False
+        self._stop_handled = False
+        self._drain_deadline = 0.0
+        # Chapters not downloaded yet, saved to the run state
+        self._remaining: MangaList = {}
+        # Closed chapters whose exporters may still be saving them
+        self._saving: Deque[Tuple[int, int, List[Future]]] = deque()
+        self._request: Dict = {}
+        self._api_url = "https://jumpg-webapi.tokyo-cdn.com"
+        self.transport = transport or LiveTransport(pool_size=workers)
+
+    def _download_image(
+        self,
+        url: str,
+        sequence: int,
+        size_hint: int,
+        cancelled: Optional[Event] = None,
+        timer: Optional[HedgeTimer] = None,
+    ) -> Optional[bytearray]:
+        started = time.monotonic()
+        try:
+            with self.transport.get(url, stream=True) as resp:
+                if cancelled is not None and cancelled.is_set():
+                    # A hedged duplicate already won, skip reading the body
+                    return None
+                # Time spent waiting for memory isn't network latency
+                latency = time.monotonic() - started
+                # Reserve memory before reading the body, so fetchers wait
+                # here when the export stage falls behind. The whole pooled
+                # buffer the page is read into is counted.
+                size = int(resp.headers.get("Content-Length") or 0)
+                reserved = self._buffers.capacity(size or size_hint)
+                with self.tracer.span("wait for memory", bytes=reserved):
+                    if timer:
+                        timer.pause()
+                    self._budget.acquire(reserved, sequence)
+                    if timer:
+                        timer.resume()
+                started = time.monotonic()
+                try:
+                    with self.tracer.span("read body", bytes=size):
+                        data = self._read_body(resp, size, size_hint)
+                except BaseException:
+                    self._budget.release(reserved)
+                    raise
+                latency += time.monotonic() - started
+                if self._hedger:
+                    self._hedger.record(latency)
+        except Exception:
+            # Connection errors and timeouts make the controller back off too
+            if self._controller:
+                self._controller.record(0, error=True)
+            raise
+        self._budget.adjust(self._buffers.capacity(len(data)) - reserved)
+        self.metrics.incr("bytes_downloaded", len(data))
+        if self._controller:
+            # Throttling and server errors make the controller back off
+            throttled = resp.status_code == 429 or resp.status_code >= 500
+            self._controller.record(latency, len(data), error=throttled)
+        return data
+
+    def _read_body(self, resp, size: int, size_hint: int) -> bytearray:
+        # Reads the body into a pooled buffer in small chunks, instead of
+        # allocating a new copy of every page. `size` is the Content-Length,
+        # without it the buffer starts from `size_hint` and grows.
+        raw = raw_body(resp)
+        if raw is None:
+            content = resp.content
+            data = self._buffers.acquire(len(content))
+            data[:] = content
+            return data
+        data = self._buffers.acquire(size or size_hint)
+        filled = 0
+        while True:
+            if filled == len(data):
+                if size:
+                    break
+                resize_buffer(data, max(len(data) * 2, READ_CHUNK_SIZE))
+            with memoryview(data) as view:
+                read = raw.readinto(view[filled : filled + READ_CHUNK_SIZE])
+            if not read:
+                break
+            filled += read
+        resize_buffer(data, filled)
+        return data
 
-    def _decrypt_image(self, url: str, encryption_hex: str) -> bytearray:
-        resp = self.session.get(url)
-        data = bytearray(resp.content)
-        key = bytes.fromhex(encryption_hex)
-        a = len(key)
-        for s in range(len(data)):
-            data[s] ^= key[s % a]
+    def _release_page(self, data: bytearray):
+        # Called once a page is exported or thrown away
+        self._budget.release(self._buffers.capacity(len(data)))
+        self._buffers.release(data)
+
+    def _decrypt_image(
+        self, url: str, encryption_hex: str, sequence: int, size_hint: int
+    ) -> bytearray:
+        with self.tracer.span("download"):
+            if self._hedger:
+                data = self._hedger.run(
+                    partial(self._download_image, url, sequence, size_hint),
+                    self._release_page,
+                )
+            else:
+                data = self._download_image(url, sequence, size_hint)
+        with self.tracer.span("decrypt", bytes=len(data)):
+            key = bytes.fromhex(encryption_hex)
+            a = len(key)
+            for s in range(len(data)):
+                data[s] ^= key[s % a]
         return data
 
-    @lru_cache(None)
-    def _load_pages(self, chapter_id: Union[str, int]) -> MangaViewer:
-        resp = self.session.get(
-            f"{self._api_url}/api/manga_viewer",
-            params={
+    def _fetch_page(
+        self, page: PagePlan, sequence: int, trace_args: Dict
+    ) -> bytearray:
+        # Truncated or mangled responses are retried and never reach exporters
+        with self.tracer.span("fetch page", **trace_args):
+            return self._fetch_verified(page, sequence)
+
+    def _fetch_verified(self, page: PagePlan, sequence: int) -> bytearray:
+        for attempt in range(1, self.retries + 1):
+            image_blob = self._decrypt_image(
+                page.image_url,
+                page.encryption_key,
+                sequence,
+                page.width * page.height // 2,
+            )
+            if not self.verify:
+                return image_blob
+            error = check_image(image_blob, page.width, page.height)
+            if error is None:
+                return image_blob
+            self._release_page(image_blob)
+            self.metrics.incr("pages_corrupt")
+            log.warning(
+                "Corrupt image (attempt %s/%s): %s: %s",
+                attempt,
+                self.retries,
+                error,
+                page.image_url,
+            )
+        raise CorruptImageError(f"{error}: {page.image_url}")
+
+    def _api_get(
+        self, endpoint: str, params: Dict, cacheable: bool = False
+    ) -> Response:
+        url = f"{self._api_url}/api/{endpoint}"
+        entry = (
+            self.cache.get(url, params) if cacheable and self.cache else None
+        )
+        with self.tracer.span("metadata request", endpoint=endpoint, **params):
+            resp = self.transport.get(
+                url,
+                params=params,
+                headers=MetadataCache.conditional_headers(entry),
+            )
+        if entry and resp.status_code == 304:
+            self.metrics.incr("metadata_not_modified")
+            return Response.FromString(entry.content)
+        self.metrics.incr("metadata_bytes", len(resp.content))
+        etag = resp.headers.get("ETag")
+        last_modified = resp.headers.get("Last-Modified")
+        # Error responses never replace a good entry
+        if (
+            cacheable
+            and self.cache
+            and resp.status_code == 200
+            and (etag or last_modified)
+        ):
+            self.cache.set(
+                url, params, CacheEntry(resp.content, etag, last_modified)
+            )
+        return Response.FromString(resp.content)
+
+    def _load_pages(
+        self, chapter_id: Union[str, int], quality: Optional[str] = None
+    ) -> MangaViewer:
+        # Not cached on disk, the viewer contains short-lived image urls
+        return self._api_get(
+            "manga_viewer",
+            {
                 "chapter_id": chapter_id,
                 "split": "yes" if self.split else "no",
-                "img_quality": self.quality,
+                "img_quality": quality or self.quality,
             },
-        )
-        return Response.FromString(resp.content).success.manga_viewer
+        ).success.manga_viewer
+
+    def _load_plan(
+        self, chapter_id: Union[str, int], quality: Optional[str] = None
+    ) -> ViewerPlan:
+        return ViewerPlan.from_viewer(self._load_pages(chapter_id, quality))
 
-    @lru_cache(None)
     def _get_title_details(self, title_id: Union[str, int]) -> TitleDetailView:
-        resp = self.session.get(
-            f"{self._api_url}/api/title_detailV3", params={"title_id": title_id}
-        )
-        return Response.FromString(resp.content).success.title_detail_view
+        details = self._api_get(
+            "title_detailV3", {"title_id": title_id}, cacheable=True
+        ).success.title_detail_view
+        # Only the few fields needed later are kept
+        self._titles[int(title_id)] = TitlePlan.from_title(details.title)
+        return details
+
+    def _get_title(self, title_id: int) -> TitlePlan:
+        if title_id not in self._titles:
+            self._get_title_details(title_id)
+        return self._titles[title_id]
 
     def _normalize_ids(
         self,
@@ -89,6 +377,8 @@ class MangaLoader:
         chapter_meta = namedtuple("ChapterMeta", "id name")
         for cid in chapter_ids:
             viewer = self._load_pages(cid)
+            # Reused by the download, unless it's filtered out
+            self._viewers[cid] = ViewerPlan.from_viewer(viewer)
             title_id = viewer.title_id
             # Fetching details for this chapter also downloads all other
             # visible chapters for the same title.
@@ -129,52 +419,417 @@ class MangaLoader:
 
         return mangas
 
+    def _get_viewer(self, chapter_id: int) -> Tuple[ViewerPlan, str]:
+        # Lower qualities are tried when the chosen one fails or has no
+        # images for this chapter
+        error, result = None, None
+        for quality in self.selector.ladder(self.selector.choose()):
+            viewer = None
+            if quality == self.quality:
+                viewer = self._viewers.pop(chapter_id, None)
+            try:
+                if viewer is None:
+                    viewer = self._load_plan(chapter_id, quality)
+            except Exception as e:
+                error = e
+                log.warning(
+                    "Failed to load chapter %s in %s quality: %s",
+                    chapter_id,
+                    quality,
+                    e,
+                )
+            else:
+                result = viewer, quality
+                if viewer.pages:
+                    return result
+                log.warning(
+                    "Chapter %s has no images in %s quality",
+                    chapter_id,
+                    quality,
+                )
+            self.metrics.incr("quality_fallbacks")
+        if result is None:
+            raise error
+        return result
+
     def _download(self, manga_list: MangaList):
         manga_num = len(manga_list)
-        for title_index, (title_id, chapters) in enumerate(
-            manga_list.items(), 1
-        ):
-            title = self._get_title_details(title_id).title
+        schedule = create_schedule(self.schedule, manga_list)
+        self.progress.start(manga_num, len(schedule))
+        self.selector.start(len(schedule))
+        # Metadata of upcoming chapters is loaded while the current chapter's
+        # images are downloading. The lookahead is kept short, so we don't
+        # hold many viewers and their signed image urls don't expire.
+        viewers = Prefetcher(
+            self._get_viewer,
+            [chapter_id for _, chapter_id in schedule],
+            self.prefetch,
+            self._metadata_pool,
+            self.metrics,
+        )
+        try:
+            self._download_titles(manga_list, schedule, viewers)
+            self._mark_saved(wait=True)
+        finally:
+            viewers.close()
+            self._viewers.clear()
 
+    def _download_titles(
+        self,
+        manga_list: MangaList,
+        schedule: List[ScheduleItem],
+        viewers: Prefetcher,
+    ):
+        manga_num = len(manga_list)
+        # Titles are numbered in the order they are first scheduled
+        title_indexes: Dict[int, int] = {}
+        chapter_indexes = {
+            chapter_id: index
+            for chapters in manga_list.values()
+            for index, chapter_id in enumerate(sorted(chapters), 1)
+        }
+        remaining = {
+            title_id: len(chapters) for title_id, chapters in manga_list.items()
+        }
+        for chapters in manga_list.values():
+            if not chapters:
+                self.progress.finish_title()
+        for title_id, chapter_id in schedule:
+            if self.stopping:
+                self._handle_stop()
+                break
+            title = self._get_title(title_id)
             title_name = title.name
-            log.info(f"{title_index}/{manga_num}) Manga: {title_name}")
-            log.info("    Author: %s", title.author)
-
-            chapter_num = len(chapters)
-            for chapter_index, chapter_id in enumerate(sorted(chapters), 1):
-                viewer = self._load_pages(chapter_id)
-                chapter = viewer.pages[-1].last_page.current_chapter
-                next_chapter = viewer.pages[-1].last_page.next_chapter
-                next_chapter = (
-                    next_chapter if next_chapter.chapter_id != 0 else None
+            # The header is logged once, titles take turns with --schedule fair
+            if title_id not in title_indexes:
+                title_index = title_indexes[title_id] = len(title_indexes) + 1
+                log.info(
+                    "%s/%s) Manga: %s",
+                    title_index,
+                    manga_num,
+                    title_name,
+                    extra={"title_id": title_id},
                 )
-                chapter_name = viewer.chapter_name
                 log.info(
-                    f"    {chapter_index}/{chapter_num}) "
-                    f"Chapter {chapter_name}: {chapter.sub_title}"
+                    "    Author: %s", title.author, extra={"title_id": title_id}
                 )
-                exporter = self.exporter(
-                    title=title, chapter=chapter, next_chapter=next_chapter
+
+            chapter_num = len(manga_list[title_id])
+            chapter_index = chapter_indexes[chapter_id]
+            viewer, quality = viewers.get(chapter_id)
+            chapter, next_chapter = viewer.chapter, viewer.next_chapter
+            chapter_name = viewer.chapter_name
+            # Fields for structured log output
+            log_fields = {"title_id": title_id, "chapter_id": chapter_id}
+            log.info(
+                "    %s/%s) Chapter %s: %s",
+                chapter_index,
+                chapter_num,
+                chapter_name,
+                chapter.sub_title,
+                extra=log_fields,
+            )
+            exporters = [
+                factory(title=title, chapter=chapter, next_chapter=next_chapter)
+                for factory in self.exporters
+            ]
+            pages = viewer.pages
+
+            if quality != self.quality:
+                log.info(
+                    "        Downloading in %s quality",
+                    quality,
+                    extra=log_fields,
                 )
-                pages = [
-                    p.manga_page for p in viewer.pages if p.manga_page.image_url
-                ]
 
-                with click.progressbar(
-                    pages, label=chapter_name, show_pos=True
-                ) as pbar:
-                    page_counter = count()
-                    for page_index, page in zip(page_counter, pbar):
-                        if PageType(page.type) == PageType.double:
-                            page_index = range(page_index, next(page_counter))
-                        if not exporter.skip_image(page_index):
-                            # Todo use asyncio + async requests 3
-                            image_blob = self._decrypt_image(
-                                page.image_url, page.encryption_key
-                            )
-                            exporter.add_image(image_blob, page_index)
-
-                exporter.close()
+            self.progress.start_chapter(
+                chapter_id, f"{title_name} {chapter_name}", len(pages)
+            )
+            downloaded = self.metrics.get("bytes_downloaded")
+            started = time.monotonic()
+            try:
+                with self.tracer.span(
+                    "chapter", title=title_id, chapter=chapter_id
+                ):
+                    quality = self._export_chapter(
+                        exporters, viewer, quality, log_fields
+                    )
+            except DownloadStopped:
+                log.info(
+                    "        Saving checkpoint of unfinished chapter",
+                    extra=log_fields,
+                )
+                for exporter in exporters:
+                    exporter.checkpoint()
+                break
+            except CorruptImageError as e:
+                # The chapter stays in the run state, so it is retried on the
+                # next run together with the pages saved so far
+                log.error(
+                    "        Skipping chapter with corrupt image: %s",
+                    e,
+                    extra=log_fields,
+                )
+                for exporter in exporters:
+                    exporter.checkpoint()
+                self.metrics.incr("chapters_failed")
+                # The title is done as far as this run is concerned
+                remaining[title_id] -= 1
+                if not remaining[title_id]:
+                    self.progress.finish_title()
+                continue
+            finally:
+                self.progress.finish_chapter(chapter_id)
+
+            with self.tracer.span("close exporters", chapter=chapter_id):
+                for exporter in exporters:
+                    exporter.close()
+            downloaded = self.metrics.get("bytes_downloaded") - downloaded
+            duration = time.monotonic() - started
+            log.info(
+                "        Finished chapter: %s bytes in %.2fs",
+                downloaded,
+                duration,
+                extra=dict(
+                    log_fields, bytes=downloaded, duration=round(duration, 3)
+                ),
+            )
+            self.selector.chapter_done(quality, downloaded)
+            self.chapter_qualities[chapter_id] = {
+                "title_id": title_id,
+                "title": title_name,
+                "chapter": chapter_name,
+                "quality": quality,
+                "requested_quality": self.quality,
+            }
+            remaining[title_id] -= 1
+            if not remaining[title_id]:
+                self.progress.finish_title()
+            self._saving.append(
+                (title_id, chapter_id, [e.saved() for e in exporters])
+            )
+            self._mark_saved(wait=False)
+            if self.profiler:
+                self.profiler.checkpoint(f"Chapter {chapter_id}")
+
+    def _export_chapter(
+        self,
+        exporters: List[ExporterBase],
+        viewer: ViewerPlan,
+        quality: str,
+        log_fields: Dict,
+    ) -> str:
+        # A chapter with a page that stays corrupt is tried once more in the
+        # next lower quality. Pages that were already saved are kept, so only
+        # the missing ones are downloaded again. Returns the quality used.
+        chapter_id = log_fields["chapter_id"]
+        try:
+            self._export_pages(exporters, viewer, viewer.pages, chapter_id)
+            return quality
+        except CorruptImageError as e:
+            lower = self.selector.ladder(quality)[1:]
+            if not lower:
+                raise
+            log.warning(
+                "        Retrying in %s quality: %s",
+                lower[0],
+                e,
+                extra=log_fields,
+            )
+            self.metrics.incr("quality_fallbacks")
+            error = e
+        viewer = self._load_plan(chapter_id, lower[0])
+        if not viewer.pages:
+            raise error
+        self._export_pages(exporters, viewer, viewer.pages, chapter_id)
+        return lower[0]
+
+    def _export_pages(
+        self,
+        exporters: List[ExporterBase],
+        viewer: ViewerPlan,
+        pages: Sequence[PagePlan],
+        chapter_id: int,
+    ):
+        jobs = []
+        page_counter = count()
+        for page_index, page in zip(page_counter, pages):
+            if PageType(page.type) == PageType.double:
+                page_index = range(page_index, next(page_counter))
+            # Pages are only fetched if at least one exporter needs them
+            targets = self._page_targets(exporters, page_index)
+            if not targets:
+                self.progress.advance(chapter_id)
+                continue
+            sequence = next(self._sequence)
+            trace_args = {
+                "title": viewer.title_id,
+                "chapter": chapter_id,
+                "page": page_label(page_index),
+            }
+            future = self._dispatcher.submit(
+                self._fetch_page, page, sequence, trace_args
+            )
+            jobs.append((page_index, targets, sequence, future))
+
+        # Pages are exported in order while later pages are still downloading
+        pending = deque()
+        try:
+            for position, (page_index, targets, sequence, future) in enumerate(
+                jobs, 1
+            ):
+                self._budget.advance(sequence)
+                image_blob = self._page_result(future)
+                if self.processor and self.processor.needs_processing(
+                    page_index
+                ):
+                    future = self.processor.submit(
+                        image_blob, page_index, viewer.start_from_right
+                    )
+                    pending.append((page_index, image_blob, targets, future))
+                elif pending:
+                    # Queued behind pages still being processed, so archive
+                    # entries are always written in page order
+                    pending.append((page_index, image_blob, targets, None))
+                else:
+                    self._export_page(page_index, image_blob, targets)
+                self.metrics.incr("pages_exported")
+                self.progress.advance(chapter_id)
+                self._export_processed(pending, wait=False)
+            self._export_processed(pending, wait=True)
+        except DownloadStopped:
+            # Pages that were downloaded are still worth keeping
+            self._export_processed(pending, wait=True)
+            raise
+        except CorruptImageError:
+            # The run goes on with the next chapter, so memory held by pages
+            # of this one has to be given back
+            self._export_processed(pending, wait=True)
+            for _, _, _, future in jobs[position:]:
+                future.cancel()
+                future.add_done_callback(self._discard_page)
+            raise
+        except BaseException:
+            for _, _, _, future in jobs:
+                future.cancel()
+            raise
+
+    def _discard_page(self, future: Future):
+        if not future.cancelled() and future.exception() is None:
+            self._release_page(future.result())
+
+    def _page_result(self, future: Future) -> bytearray:
+        # Waits in short slices, so a stop request is noticed even while a
+        # page is still downloading
+        while not self.stopping:
+            try:
+                return future.result(timeout=STOP_CHECK_INTERVAL)
+            except FutureTimeout:
+                continue
+            except CancelledError:
+                break
+        self._handle_stop()
+        # Pages already downloading get until the drain deadline
+        timeout = max(self._drain_deadline - time.monotonic(), 0)
+        try:
+            return future.result(timeout=timeout)
+        except (CancelledError, FutureTimeout):
+            raise DownloadStopped()
+
+    def _export_page(
+        self,
+        page_index: Union[int, range],
+        image_blob: bytearray,
+        targets: List[ExporterBase],
+    ):
+        with self.tracer.span("export page", page=page_label(page_index)):
+            for exporter in targets:
+                exporter.add_image(image_blob, page_index)
+        self._release_page(image_blob)
+
+    def _export_processed(self, pending: Deque, wait: bool):
+        while pending and (
+            wait or pending[0][3] is None or pending[0][3].done()
+        ):
+            page_index, image_blob, targets, future = pending.popleft()
+            if future is None:
+                self._export_page(page_index, image_blob, targets)
+                continue
+            for index, blob, ext in future.result():
+                with self.tracer.span("export page", page=page_label(index)):
+                    for exporter in targets:
+                        if not exporter.skip_image(index, ext):
+                            exporter.add_image(blob, index, ext)
+            # The processor is done with the original by now
+            self._release_page(image_blob)
+
+    def _page_targets(
+        self, exporters: List[ExporterBase], page_index: Union[int, range]
+    ) -> List[ExporterBase]:
+        if not self.processor:
+            return [e for e in exporters if not e.skip_image(page_index)]
+        indexes = self.processor.output_indexes(page_index)
+        return [
+            e
+            for e in exporters
+            if not all(
+                e.skip_image(index, self.processor.extension)
+                for index in indexes
+            )
+        ]
+
+    @property
+    def stopping(self) -> bool:
+        return self._stop_requested
+
+    def stop(self):
+        # Safe to call from a signal handler, so it takes no locks and
+        # doesn't log. No new pages are fetched, pages in flight are
+        # exported until the drain timeout and the unfinished chapter is
+        # checkpointed.
+        if self._stop_requested:
+            return
+        self._drain_deadline = time.monotonic() + self.drain_timeout
+        self._stop_requested = True
+
+    def _handle_stop(self):
+        # Called from the download loop once a stop was requested
+        if not self._stop_requested or self._stop_handled:
+            return
+        self._stop_handled = True
+        log.info(
+            "Stopping, waiting up to %ss for running downloads",
+            self.drain_timeout,
+        )
+        if self._dispatcher:
+            self._dispatcher.stop()
+
+    def _mark_saved(self, wait: bool):
+        # Chapters only leave the run state once all exporters saved them,
+        # archives are still being written after close() returns
+        changed = False
+        while self._saving and (
+            wait or all(future.done() for future in self._saving[0][2])
+        ):
+            title_id, chapter_id, futures = self._saving.popleft()
+            errors = [f.exception() for f in futures if f.exception()]
+            if errors:
+                log.error(
+                    "Failed to save chapter %s: %s",
+                    chapter_id,
+                    errors[0],
+                    extra={"title_id": title_id, "chapter_id": chapter_id},
+                )
+                self.metrics.incr("chapters_failed")
+                continue
+            self._remaining[title_id].discard(chapter_id)
+            changed = True
+        if changed:
+            self._save_state()
+
+    def _save_state(self):
+        if self.state:
+            self.state.save(self._request, self._remaining, self._titles)
 
     def download(
         self,
@@ -185,7 +840,108 @@ class MangaLoader:
         max_chapter: int,
         last_chapter: bool = False,
     ):
-        manga_list = self._normalize_ids(
-            title_ids, chapter_ids, min_chapter, max_chapter, last_chapter
+        self._request = {
+            "title_ids": title_ids or [],
+            "chapter_ids": chapter_ids or [],
+            "min_chapter": min_chapter,
+            "max_chapter": max_chapter,
+            "last_chapter": last_chapter,
+        }
+        resumed = self.state and self.state.load(self._request)
+        if resumed:
+            manga_list, self._titles = resumed
+            log.info(
+                "Resuming interrupted run, %s chapters left",
+                sum(len(chapters) for chapters in manga_list.values()),
+            )
+        else:
+            manga_list = self._normalize_ids(
+                title_ids, chapter_ids, min_chapter, max_chapter, last_chapter
+            )
+        self._remaining = {
+            title_id: set(chapters) for title_id, chapters in manga_list.items()
+        }
+        self._save_state()
+        if self.local_split or self.image_format or self.max_image_size:
+            self.processor = ImageProcessor(
+                split_mode=self.local_split,
+                image_format=self.image_format,
+                quality=self.image_quality,
+                max_size=self.max_image_size,
+                tracer=self.tracer,
+            )
+        self._budget = ByteBudget(self.max_buffer_size, self.metrics)
+        self._buffers = BufferPool(self._budget, self.metrics)
+        self._fetch_pool = ThreadPoolExecutor(
+            self.workers, thread_name_prefix="fetch"
+        )
+        if self.adaptive:
+            # --workers is the upper bound of the adaptive limit
+            self._controller = AIMDController(
+                self.metrics, initial=2, maximum=self.workers
+            )
+            self._dispatcher = Dispatcher(
+                self._fetch_pool, lambda: self._controller.limit
+            )
+        else:
+            self._dispatcher = Dispatcher(
+                self._fetch_pool, lambda: self.workers
+            )
+        # Separate from page fetches so metadata doesn't queue behind images
+        self._metadata_pool = ThreadPoolExecutor(
+            max(self.prefetch, 1), thread_name_prefix="metadata"
+        )
+        if self.hedge_percentile:
+            # Room for a primary request and a duplicate per fetch worker
+            self._hedge_pool = ThreadPoolExecutor(
+                self.workers * 2, thread_name_prefix="hedge"
+            )
+            self._hedger = Hedger(
+                self._hedge_pool,
+                self.metrics,
+                percentile=self.hedge_percentile,
+                max_ratio=self.hedge_max_ratio,
+            )
+        try:
+            self._download(manga_list)
+            failed = sum(len(chapters) for chapters in self._remaining.values())
+            if failed and not self.stopping:
+                log.error("%s chapters failed, run again to retry", failed)
+            elif self.state and not self.stopping:
+                self.state.clear()
+        finally:
+            self._handle_stop()
+            # Wakes up fetchers waiting for memory if the run failed
+            self._budget.close()
+            # Downloads still running after the drain timeout are abandoned
+            wait = not self.stopping
+            self._fetch_pool.shutdown(wait)
+            self._metadata_pool.shutdown(wait)
+            if self._hedge_pool:
+                self._hedge_pool.shutdown(wait)
+                self._hedge_pool = self._hedger = None
+            self.progress.close()
+            if self.processor:
+                self.processor.close()
+                self.processor = None
+            log.info("Metrics: %s", self.metrics.format())
+            if self.quality_report:
+                self._write_quality_report()
+            if self.trace:
+                self.tracer.write(self.trace)
+                log.info("Trace written to %s", self.trace)
+
+    def _write_quality_report(self):
+        # Merged with an existing report, so chapters downloaded in an
+        # earlier run below the requested quality can be found and upgraded
+        try:
+            with open(self.quality_report) as f:
+                report = json.load(f)
+        except (OSError, ValueError):
+            report = {}
+        report.update(
+            (str(chapter_id), info)
+            for chapter_id, info in self.chapter_qualities.items()
         )
-        self._download(manga_list)
+        with open(self.quality_report, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
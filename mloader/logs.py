@@ -0,0 +1,42 @@
+import json
+import logging
+from datetime import datetime
+from logging.handlers import QueueHandler
+
+LOG_FORMATS = ("text", "json")
+
+# Attributes every LogRecord has, anything else was passed with `extra`
+_RECORD_ATTRIBUTES = set(
+    vars(logging.LogRecord("", 0, "", 0, "", (), None))
+) | {"message", "asctime"}
+
+
+class JSONFormatter(logging.Formatter):
+    # One JSON object per line. Fields passed with `extra`, e.g. title_id or
+    # bytes, become keys of their own.
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created)
+            .astimezone()
+            .isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "file": record.filename,
+            "line": record.lineno,
+            "message": record.getMessage().strip(),
+        }
+        entry.update(
+            (key, value)
+            for key, value in vars(record).items()
+            if key not in _RECORD_ATTRIBUTES
+        )
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class LazyQueueHandler(QueueHandler):
+    # QueueHandler formats the message in the logging thread, records are
+    # passed as they are so formatting happens on the listener thread.
+    # Only safe with a queue in the same process.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
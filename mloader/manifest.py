@@ -0,0 +1,80 @@
+import json
+import os
+from collections import namedtuple
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Optional
+
+from mloader.utils import file_digest
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+ArchiveRecord = namedtuple("ArchiveRecord", "sha256 size mtime_ns")
+
+
+class LibraryManifest:
+    # Checksums of the archives saved to a library, kept in `MANIFEST_NAME`
+    # at its root. Like rsync, a file whose size and modification time are
+    # unchanged isn't hashed again.
+    def __init__(self, root: str):
+        self.root = Path(root)
+        self.path = self.root.joinpath(MANIFEST_NAME)
+        self._archives: Dict[str, ArchiveRecord] = {}
+        self._dirty = False
+        self._lock = Lock()
+        try:
+            manifest = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return
+        if manifest.get("version") == MANIFEST_VERSION:
+            self._archives = {
+                name: ArchiveRecord(**record)
+                for name, record in manifest["archives"].items()
+            }
+
+    def _key(self, path: Path) -> str:
+        return Path(os.path.relpath(path, self.root)).as_posix()
+
+    def get(self, path: Path) -> Optional[ArchiveRecord]:
+        with self._lock:
+            return self._archives.get(self._key(path))
+
+    def add(self, path: Path, sha256: Optional[str] = None):
+        stat = path.stat()
+        record = ArchiveRecord(
+            sha256 or file_digest(path), stat.st_size, stat.st_mtime_ns
+        )
+        with self._lock:
+            self._archives[self._key(path)] = record
+            self._dirty = True
+
+    def is_unchanged(self, path: Path) -> Optional[bool]:
+        # None for archives that were never recorded
+        record = self.get(path)
+        if record is None:
+            return None
+        stat = path.stat()
+        if (stat.st_size, stat.st_mtime_ns) == (record.size, record.mtime_ns):
+            return True
+        if stat.st_size != record.size or file_digest(path) != record.sha256:
+            return False
+        # Only touched, e.g. copied back from a backup
+        self.add(path, record.sha256)
+        return True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            manifest = {
+                "version": MANIFEST_VERSION,
+                "archives": {
+                    name: record._asdict()
+                    for name, record in sorted(self._archives.items())
+                },
+            }
+            self._dirty = False
+        tmp = self.path.with_name(f"{self.path.name}.tmp")
+        tmp.write_text(json.dumps(manifest, indent=1))
+        os.replace(tmp, self.path)
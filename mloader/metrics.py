@@ -0,0 +1,39 @@
+from threading import Lock
+from typing import Dict, Union
+
+Number = Union[int, float]
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = Lock()
+        self._values: Dict[str, Number] = {}
+
+    def incr(self, name: str, value: Number = 1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + value
+
+    def set(self, name: str, value: Number):
+        # Gauges also keep track of their highest value
+        peak = f"{name}_peak"
+        with self._lock:
+            self._values[name] = value
+            self._values[peak] = max(self._values.get(peak, value), value)
+
+    def get(self, name: str, default: Number = 0) -> Number:
+        with self._lock:
+            return self._values.get(name, default)
+
+    def snapshot(self) -> Dict[str, Number]:
+        with self._lock:
+            return dict(self._values)
+
+    def format(self) -> str:
+        return ", ".join(
+            (
+                f"{name}={value:.3f}"
+                if isinstance(value, float)
+                else f"{name}={value}"
+            )
+            for name, value in sorted(self.snapshot().items())
+        )
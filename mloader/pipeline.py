@@ -0,0 +1,494 @@
+import logging
+import time
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    TimeoutError as FutureTimeout,
+    wait,
+)
+from functools import partial
+from threading import Condition, Event, Lock
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Sequence,
+    TypeVar,
+)
+
+from mloader.metrics import Metrics
+
+log = logging.getLogger()
+
+T = TypeVar("T")
+
+
+class ByteBudget:
+    # Limits the amount of downloaded page data that is waiting to be
+    # exported. Fetchers block in acquire() until the export stage catches
+    # up. The page the export stage is waiting for is always admitted,
+    # otherwise fetchers holding later pages could starve it.
+    def __init__(self, limit: int, metrics: Metrics):
+        self.limit = limit
+        self.metrics = metrics
+        self._used = 0
+        self._next_sequence = 0
+        self._closed = False
+        self._cond = Condition()
+
+    @property
+    def used(self) -> int:
+        with self._cond:
+            return self._used
+
+    def _update(self, delta: int):
+        self._used += delta
+        self.metrics.set("buffered_bytes", self._used)
+
+    def acquire(self, size: int, sequence: int):
+        with self._cond:
+            while (
+                not self._closed
+                and self._used
+                and self._used + size > self.limit
+                and sequence != self._next_sequence
+            ):
+                self.metrics.incr("budget_waits")
+                self._cond.wait()
+            self._update(size)
+
+    def adjust(self, delta: int):
+        # Fixes up a reservation once the real size is known, never blocks
+        with self._cond:
+            self._update(delta)
+            if delta < 0:
+                self._cond.notify_all()
+
+    def release(self, size: int):
+        self.adjust(-size)
+
+    def advance(self, sequence: int):
+        # Called by the export stage when it starts waiting for `sequence`
+        with self._cond:
+            self._next_sequence = sequence
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class BufferPool:
+    # Reusable buffers for downloaded pages. Buffers are grouped by size
+    # class, a power of two of at least `min_size` bytes, and resized within
+    # their class when handed out. CPython keeps the allocation of a
+    # bytearray that shrinks to no less than half its size, so the memory
+    # itself is reused. Pages in use are charged to `budget` by capacity,
+    # idle buffers are dropped when they and the pages in use would exceed
+    # its limit.
+    def __init__(
+        self, budget: ByteBudget, metrics: Metrics, min_size: int = 64 * 1024
+    ):
+        self.budget = budget
+        self.metrics = metrics
+        self.min_size = min_size
+        self._free: Dict[int, List[bytearray]] = {}
+        self._idle = 0
+        self._lock = Lock()
+
+    def capacity(self, size: int) -> int:
+        # Memory held by a buffer of `size` bytes
+        return max(self.min_size, 1 << max(size - 1, 0).bit_length())
+
+    def acquire(self, size: int) -> bytearray:
+        capacity = self.capacity(size)
+        with self._lock:
+            free = self._free.get(capacity)
+            buffer = free.pop() if free else None
+            if buffer is not None:
+                self._idle -= capacity
+            self._trim()
+        if buffer is None:
+            self.metrics.incr("buffer_pool_misses")
+            buffer = bytearray(capacity)
+        else:
+            self.metrics.incr("buffer_pool_hits")
+        resize_buffer(buffer, size)
+        return buffer
+
+    def release(self, buffer: bytearray):
+        # The buffer must not be used by the caller afterwards, and must be
+        # released from the budget first
+        capacity = self.capacity(len(buffer))
+        with self._lock:
+            self._free.setdefault(capacity, []).append(buffer)
+            self._idle += capacity
+            self._trim()
+
+    def _trim(self):
+        # Largest buffers go first, so as few as possible are dropped
+        excess = self._idle + self.budget.used - self.budget.limit
+        for capacity in sorted(self._free, reverse=True):
+            free = self._free[capacity]
+            while excess > 0 and free:
+                free.pop()
+                self._idle -= capacity
+                excess -= capacity
+                self.metrics.incr("buffer_pool_dropped")
+        self.metrics.set("buffer_pool_idle_bytes", self._idle)
+
+
+def resize_buffer(buffer: bytearray, size: int):
+    if size < len(buffer):
+        del buffer[size:]
+    elif size > len(buffer):
+        buffer.extend(bytes(size - len(buffer)))
+
+
+class Prefetcher:
+    # Fetches values for the next `depth` keys in the background while the
+    # current one is being worked on. Keys are expected to be requested in
+    # order, at most `depth` prefetched values are held at a time.
+    def __init__(
+        self,
+        fetch: Callable[[Hashable], Any],
+        keys: Sequence[Hashable],
+        depth: int,
+        executor: Executor,
+        metrics: Metrics,
+    ):
+        self._fetch = fetch
+        self._keys = list(keys)
+        self._depth = depth
+        self._executor = executor
+        self.metrics = metrics
+        self._position = 0
+        self._futures: Dict[Hashable, Future] = {}
+
+    def get(self, key: Hashable) -> Any:
+        future = self._futures.pop(key, None)
+        if self._keys[self._position : self._position + 1] == [key]:
+            self._position += 1
+        self._schedule()
+        if future is None:
+            return self._fetch(key)
+        if future.done():
+            self.metrics.incr("prefetch_hits")
+        else:
+            started = time.monotonic()
+            future.result()
+            self.metrics.incr("prefetch_wait", time.monotonic() - started)
+        return future.result()
+
+    def _schedule(self):
+        for key in self._keys[self._position : self._position + self._depth]:
+            if key not in self._futures:
+                self._futures[key] = self._executor.submit(self._fetch, key)
+
+    def close(self):
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+
+
+class HedgeTimer:
+    # Time a fetch has been running for, without the time it was paused
+    # while waiting for memory
+    def __init__(self):
+        self._lock = Lock()
+        self._elapsed = 0.0
+        self._since: Optional[float] = None
+
+    def resume(self):
+        with self._lock:
+            if self._since is None:
+                self._since = time.monotonic()
+
+    def pause(self):
+        with self._lock:
+            if self._since is not None:
+                self._elapsed += time.monotonic() - self._since
+                self._since = None
+
+    def elapsed(self) -> float:
+        with self._lock:
+            if self._since is None:
+                return self._elapsed
+            return self._elapsed + time.monotonic() - self._since
+
+
+class Hedger:
+    # Sends a duplicate request when a fetch takes longer than a running
+    # latency percentile and returns whichever finishes first. Only
+    # `max_ratio` of all fetches may be duplicated.
+    def __init__(
+        self,
+        executor: Executor,
+        metrics: Metrics,
+        percentile: float = 95.0,
+        max_ratio: float = 0.05,
+        min_samples: int = 20,
+        window: int = 500,
+    ):
+        self._executor = executor
+        self.metrics = metrics
+        self.percentile = percentile
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self._lock = Lock()
+        self._requests = 0
+        self._fired = 0
+
+    def _delay(self) -> Optional[float]:
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        index = int(len(latencies) * self.percentile / 100)
+        return latencies[min(index, len(latencies) - 1)]
+
+    def _allow(self) -> bool:
+        with self._lock:
+            if self._fired + 1 > self.max_ratio * self._requests:
+                return False
+            self._fired += 1
+            return True
+
+    def record(self, latency: float):
+        # Called by `fetch` with its network latency, time spent queued or
+        # waiting for memory would make hedges fire too late
+        with self._lock:
+            self._latencies.append(latency)
+
+    @staticmethod
+    def _start(fetch: Callable, cancelled: Event, timer: HedgeTimer):
+        timer.resume()
+        return fetch(cancelled, timer)
+
+    def _wait(self, future: Future, timer: HedgeTimer, delay: float):
+        # Waits until `future` is done or has been running for `delay`.
+        # Time spent queued or paused doesn't count.
+        while True:
+            remaining = delay - timer.elapsed()
+            if remaining <= 0:
+                raise FutureTimeout()
+            try:
+                return future.result(timeout=remaining)
+            except FutureTimeout:
+                continue
+
+    def run(
+        self,
+        fetch: Callable[[Event, HedgeTimer], Optional[T]],
+        discard: Callable[[T], None],
+    ) -> T:
+        # `fetch` should give up and return None once its event is set, and
+        # pause its timer while it waits for anything but the network.
+        # `discard` is called with the losing result.
+        with self._lock:
+            self._requests += 1
+        delay = self._delay()
+        primary_cancelled, primary_timer = Event(), HedgeTimer()
+        primary = self._executor.submit(
+            self._start, fetch, primary_cancelled, primary_timer
+        )
+        if delay is None:
+            return primary.result()
+        try:
+            return self._wait(primary, primary_timer, delay)
+        except FutureTimeout:
+            if not self._allow():
+                return primary.result()
+
+        self.metrics.incr("hedges_fired")
+        hedge_cancelled = Event()
+        hedge = self._executor.submit(
+            self._start, fetch, hedge_cancelled, HedgeTimer()
+        )
+        done, _ = wait((primary, hedge), return_when=FIRST_COMPLETED)
+        winner = primary if primary in done else hedge
+        if winner.exception() is not None:
+            winner = hedge if winner is primary else primary
+        loser, loser_cancelled = (
+            (hedge, hedge_cancelled)
+            if winner is primary
+            else (primary, primary_cancelled)
+        )
+        loser_cancelled.set()
+        hedge_won = None
+        if winner is hedge:
+            self.metrics.incr("hedges_won")
+            hedge_won = time.monotonic()
+        loser.add_done_callback(partial(self._discard, discard, hedge_won))
+        return winner.result()
+
+    def _discard(
+        self, discard: Callable, hedge_won: Optional[float], future: Future
+    ):
+        if future.cancelled() or future.exception() is not None:
+            return
+        if hedge_won is not None:
+            # Time the slow request needed after the hedge finished, a lower
+            # bound since it stops early once it learns that it lost
+            saved = time.monotonic() - hedge_won
+            self.metrics.incr("hedge_saved_seconds", saved)
+        if future.result() is not None:
+            discard(future.result())
+
+
+class Dispatcher:
+    # Submits calls to the executor in order while keeping at most `limit()`
+    # of them running. Workers never wait for a slot, so the head of the
+    # queue always runs before later calls.
+    def __init__(self, executor: Executor, limit: Callable[[], int]):
+        self._executor = executor
+        self._limit = limit
+        self._queue: Deque = deque()
+        self._running = 0
+        self._stopped = False
+        self._lock = Lock()
+
+    def submit(self, fn: Callable, *args) -> Future:
+        future = Future()
+        with self._lock:
+            if self._stopped:
+                future.cancel()
+                return future
+            self._queue.append((future, fn, args))
+        self._dispatch()
+        return future
+
+    def _dispatch(self):
+        ready = []
+        with self._lock:
+            while self._queue and self._running < self._limit():
+                future, fn, args = self._queue.popleft()
+                if future.set_running_or_notify_cancel():
+                    self._running += 1
+                    ready.append((future, fn, args))
+        for future, fn, args in ready:
+            inner = self._executor.submit(fn, *args)
+            inner.add_done_callback(partial(self._done, future))
+
+    def stop(self):
+        # Cancels calls that haven't started, running ones are left to finish
+        with self._lock:
+            self._stopped = True
+            queue, self._queue = self._queue, deque()
+        for future, _, _ in queue:
+            future.cancel()
+
+    def _done(self, future: Future, inner: Future):
+        with self._lock:
+            self._running -= 1
+        if inner.exception() is not None:
+            future.set_exception(inner.exception())
+        else:
+            future.set_result(inner.result())
+        self._dispatch()
+
+
+class AIMDController:
+    # Adapts the number of concurrent page fetches: the limit grows by one
+    # while throughput rises and latency stays within `latency_tolerance` of
+    # the baseline, and is halved on errors, throttling or latency spikes.
+    # It is cut at most once per window, requests already in flight when it
+    # is cut often fail for the same reason.
+    def __init__(
+        self,
+        metrics: Metrics,
+        initial: int = 2,
+        minimum: int = 1,
+        maximum: int = 16,
+        increase_threshold: float = 1.05,
+        latency_tolerance: float = 1.2,
+        spike_factor: float = 2.0,
+        baseline_windows: int = 10,
+    ):
+        self.metrics = metrics
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase_threshold = increase_threshold
+        self.latency_tolerance = latency_tolerance
+        self.spike_factor = spike_factor
+        self._limit = max(minimum, min(initial, maximum))
+        self._lock = Lock()
+        # The baseline is the lowest median latency of the recent windows,
+        # so it follows the server when it gets slower for good
+        self._medians: Deque[float] = deque(maxlen=baseline_windows)
+        self._throughput = 0.0
+        self._cut = False
+        self._reset_window()
+        self.metrics.set("concurrency_limit", self._limit)
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    def _reset_window(self):
+        self._window_started = time.monotonic()
+        self._latencies = []
+        self._errors = 0
+        self._bytes = 0
+
+    def record(self, latency: float, size: int = 0, error: bool = False):
+        with self._lock:
+            if error:
+                self._errors += 1
+                if not self._cut:
+                    self._decrease("error")
+                    return
+            else:
+                self._latencies.append(latency)
+                self._bytes += size
+            # Each window holds a couple of requests per slot
+            if len(self._latencies) + self._errors >= 2 * self._limit:
+                self._evaluate()
+
+    def _evaluate(self):
+        self._cut = False
+        if not self._latencies:
+            # Every request of the window failed
+            self._decrease("error")
+            return
+        elapsed = time.monotonic() - self._window_started
+        throughput = self._bytes / elapsed if elapsed else 0.0
+        latency = sorted(self._latencies)[len(self._latencies) // 2]
+        baseline = min(self._medians, default=latency)
+        self._medians.append(latency)
+
+        if latency > baseline * self.spike_factor:
+            self._decrease("latency spike")
+        elif (
+            not self._errors
+            and latency <= baseline * self.latency_tolerance
+            and throughput > self._throughput * self.increase_threshold
+            and self._limit < self.maximum
+        ):
+            self._set_limit(self._limit + 1, "throughput increase")
+        self._throughput = throughput
+        self._reset_window()
+
+    def _decrease(self, reason: str):
+        self._set_limit(max(self.minimum, self._limit // 2), reason)
+        # Measurements taken at the old limit don't describe the new one
+        self._throughput = 0.0
+        self._reset_window()
+        self._cut = True
+
+    def _set_limit(self, limit: int, reason: str):
+        if limit == self._limit:
+            return
+        direction = "increases" if limit > self._limit else "decreases"
+        log.info("Concurrency limit %s -> %s (%s)", self._limit, limit, reason)
+        self._limit = limit
+        self.metrics.incr(f"concurrency_{direction}")
+        self.metrics.set("concurrency_limit", limit)
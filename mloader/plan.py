@@ -0,0 +1,104 @@
+from collections import namedtuple
+from typing import Dict, Optional, Tuple
+
+from mloader.response_pb2 import Chapter, MangaViewer, Title
+
+# The fields of a MangaPage needed to fetch and export it
+PagePlan = namedtuple("PagePlan", "image_url encryption_key type width height")
+
+
+class TitlePlan:
+    # The fields of a Title used by the loader and exporters
+    __slots__ = ("title_id", "name", "author", "language")
+
+    def __init__(self, title_id: int, name: str, author: str, language: int):
+        self.title_id = title_id
+        self.name = name
+        self.author = author
+        self.language = language
+
+    @classmethod
+    def from_title(cls, title: Title) -> "TitlePlan":
+        return cls(title.title_id, title.name, title.author, title.language)
+
+    def to_dict(self) -> Dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "TitlePlan":
+        return cls(**data)
+
+
+class ChapterPlan:
+    # The fields of a Chapter used by the exporters
+    __slots__ = ("chapter_id", "name", "sub_title")
+
+    def __init__(self, chapter_id: int, name: str, sub_title: str):
+        self.chapter_id = chapter_id
+        self.name = name
+        self.sub_title = sub_title
+
+
+def _chapter_plan(chapter: Chapter) -> ChapterPlan:
+    return ChapterPlan(chapter.chapter_id, chapter.name, chapter.sub_title)
+
+
+class ViewerPlan:
+    # Everything needed to download a chapter, extracted from its MangaViewer
+    # so the protobuf message can be released right away
+    __slots__ = (
+        "title_id",
+        "chapter_id",
+        "chapter_name",
+        "chapter",
+        "next_chapter",
+        "start_from_right",
+        "pages",
+    )
+
+    def __init__(
+        self,
+        title_id: int,
+        chapter_id: int,
+        chapter_name: str,
+        chapter: ChapterPlan,
+        next_chapter: Optional[ChapterPlan],
+        start_from_right: bool,
+        pages: Tuple[PagePlan, ...],
+    ):
+        self.title_id = title_id
+        self.chapter_id = chapter_id
+        self.chapter_name = chapter_name
+        self.chapter = chapter
+        self.next_chapter = next_chapter
+        self.start_from_right = start_from_right
+        self.pages = pages
+
+    @classmethod
+    def from_viewer(cls, viewer: MangaViewer) -> "ViewerPlan":
+        chapter = ChapterPlan(viewer.chapter_id, viewer.chapter_name, "")
+        next_chapter = None
+        if viewer.pages:
+            last_page = viewer.pages[-1].last_page
+            chapter = _chapter_plan(last_page.current_chapter)
+            if last_page.next_chapter.chapter_id != 0:
+                next_chapter = _chapter_plan(last_page.next_chapter)
+        return cls(
+            viewer.title_id,
+            viewer.chapter_id,
+            viewer.chapter_name,
+            chapter,
+            next_chapter,
+            viewer.start_from_right,
+            tuple(
+                PagePlan(
+                    p.manga_page.image_url,
+                    p.manga_page.encryption_key,
+                    p.manga_page.type,
+                    p.manga_page.width,
+                    p.manga_page.height,
+                )
+                for p in viewer.pages
+                if p.manga_page.image_url
+            ),
+        )
@@ -0,0 +1,153 @@
+import cProfile
+import logging
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+from typing import Collection, List, Optional
+
+log = logging.getLogger()
+
+PROFILE_MODES = ("cpu", "memory", "sample")
+
+
+class Sampler:
+    # Records where every thread is at a fixed interval. Unlike cProfile
+    # the cost doesn't grow with the number of function calls.
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples = 0
+        self.functions: Counter = Counter()
+        self.threads: Counter = Counter()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="mloader-sampler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                code = frame.f_code
+                name = names.get(ident, str(ident))
+                # Pool threads are grouped by their prefix, e.g. fetch_3
+                self.threads[re.sub(r"_\d+$", "", name)] += 1
+                self.functions[
+                    f"{code.co_filename}:{frame.f_lineno} {code.co_name}"
+                ] += 1
+            self.samples += 1
+
+    def report(self, limit: int = 30) -> List[str]:
+        total = sum(self.threads.values()) or 1
+        lines = [
+            f"{self.samples} samples every {self.interval * 1000:.0f}ms",
+            "",
+            "Threads:",
+        ]
+        lines.extend(
+            f"{count / total:7.1%}  {name}"
+            for name, count in self.threads.most_common()
+        )
+        lines.extend(["", "Functions:"])
+        lines.extend(
+            f"{count / total:7.1%}  {location}"
+            for location, count in self.functions.most_common(limit)
+        )
+        return lines
+
+
+class Profiler:
+    # Collects profiling data for a whole run and writes it to `directory`:
+    # cpu.pstats from cProfile for all threads, memory.txt with the top
+    # allocations at every chapter boundary and sample.txt with the share
+    # of wall time per thread and function
+    def __init__(self, directory: str, modes: Collection[str]):
+        self.path = Path(directory)
+        self.modes = set(modes)
+        self.sampler = Sampler() if "sample" in self.modes else None
+        self._profiles: List[cProfile.Profile] = []
+        self._lock = threading.Lock()
+        self._memory_report: List[str] = []
+        self._started = time.monotonic()
+
+    def start(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._started = time.monotonic()
+        if self.sampler:
+            self.sampler.start()
+        if "cpu" in self.modes:
+            # cProfile only sees the thread it is enabled in, every thread
+            # started from now on gets its own profile
+            threading.setprofile(self._profile_thread)
+            self._enable_profile()
+        if "memory" in self.modes:
+            tracemalloc.start()
+
+    def _enable_profile(self):
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        profile.enable()
+
+    def _profile_thread(self, frame, event, arg):
+        # Called once in every new thread, enabling the profile replaces
+        # this hook for the thread
+        sys.setprofile(None)
+        self._enable_profile()
+
+    def checkpoint(self, label: str, limit: int = 10):
+        # Called at chapter boundaries
+        if not tracemalloc.is_tracing():
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        elapsed = time.monotonic() - self._started
+        self._memory_report.append(
+            f"{label} at {elapsed:.1f}s: current {current / 1024:.0f} KiB, "
+            f"peak {peak / 1024:.0f} KiB"
+        )
+        self._memory_report.extend(
+            f"  {stat}" for stat in snapshot.statistics("lineno")[:limit]
+        )
+        self._memory_report.append("")
+
+    def stop(self):
+        if "cpu" in self.modes:
+            threading.setprofile(None)
+            with self._lock:
+                profiles, self._profiles = self._profiles, []
+            # Only the current thread's profile is still running, threads
+            # of the finished pools stopped with them
+            profiles[0].disable()
+            pstats.Stats(*profiles).dump_stats(
+                str(self.path.joinpath("cpu.pstats"))
+            )
+        if "memory" in self.modes:
+            self.checkpoint("Finished")
+            tracemalloc.stop()
+            self.path.joinpath("memory.txt").write_text(
+                "\n".join(self._memory_report)
+            )
+        if self.sampler:
+            self.sampler.stop()
+            self.path.joinpath("sample.txt").write_text(
+                "\n".join(self.sampler.report()) + "\n"
+            )
+        log.info("Profile written to %s", self.path)
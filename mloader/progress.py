@@ -0,0 +1,219 @@
+import json
+import logging
+import sys
+import time
+from threading import Event, Lock, Thread
+from typing import Dict, Hashable, List, Optional, TextIO, Tuple
+
+from mloader.metrics import Metrics
+
+PROGRESS_MODES = ("auto", "tty", "json", "silent")
+
+
+class ChapterProgress:
+    __slots__ = ("name", "done", "total")
+
+    def __init__(self, name: str, total: int):
+        self.name = name
+        self.done = 0
+        self.total = total
+
+
+class Progress:
+    # Aggregates progress of the whole run. Counters are updated from the
+    # download threads, rendering happens on a background thread at a fixed
+    # rate so output cost doesn't depend on the page rate. This base class
+    # only tracks state and is used as the silent mode.
+    interval: Optional[float] = None
+
+    def __init__(
+        self,
+        metrics: Optional[Metrics] = None,
+        interval: Optional[float] = None,
+        stream: TextIO = sys.stdout,
+    ):
+        self.metrics = metrics or Metrics()
+        self.stream = stream
+        if interval is not None:
+            self.interval = interval
+        self.titles_total = self.titles_done = 0
+        self.chapters_total = self.chapters_done = 0
+        self.pages_total = self.pages_done = 0
+        self.active: Dict[Hashable, ChapterProgress] = {}
+        self.started = time.monotonic()
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread: Optional[Thread] = None
+
+    def start(self, titles: int, chapters: int):
+        with self._lock:
+            self.titles_total = titles
+            self.chapters_total = chapters
+            self.started = time.monotonic()
+        if self.interval and self._thread is None:
+            self._thread = Thread(
+                target=self._run, name="mloader-progress", daemon=True
+            )
+            self._thread.start()
+
+    def finish_title(self):
+        with self._lock:
+            self.titles_done += 1
+
+    def start_chapter(self, key: Hashable, name: str, pages: int):
+        with self._lock:
+            self.active[key] = ChapterProgress(name, pages)
+            self.pages_total += pages
+
+    def advance(self, key: Hashable, pages: int = 1):
+        with self._lock:
+            self.active[key].done += pages
+            self.pages_done += pages
+
+    def finish_chapter(self, key: Hashable):
+        with self._lock:
+            chapter = self.active.pop(key)
+            # Account for pages that were never reported, e.g. on failure
+            self.pages_done += chapter.total - chapter.done
+            self.chapters_done += 1
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.render(final=True)
+
+    def status(self) -> dict:
+        with self._lock:
+            elapsed = time.monotonic() - self.started
+            downloaded = self.metrics.get("bytes_downloaded")
+            return {
+                "elapsed": round(elapsed, 1),
+                "titles": [self.titles_done, self.titles_total],
+                "chapters": [self.chapters_done, self.chapters_total],
+                "pages": [self.pages_done, self.pages_total],
+                "bytes": downloaded,
+                "bytes_per_second": int(downloaded / elapsed) if elapsed else 0,
+                "buffered_bytes": self.metrics.get("buffered_bytes"),
+                "active": [
+                    {"chapter": c.name, "pages": [c.done, c.total]}
+                    for c in self.active.values()
+                ],
+            }
+
+    def render(self, final: bool = False):
+        pass
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.render()
+
+
+def _format_size(size: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            break
+        size /= 1024
+    return f"{size:.1f} {unit}"
+
+
+class TTYProgress(Progress):
+    interval = 0.25
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._drawn_lines = 0
+        self._output_lock = Lock()
+        self._filters: List[Tuple[logging.Handler, logging.Filter]] = []
+
+    def start(self, titles: int, chapters: int):
+        # Log records are only interleaved with the display while it is shown
+        if not self._filters:
+            for handler in logging.getLogger().handlers:
+                log_filter = _EraseProgressFilter(self)
+                handler.addFilter(log_filter)
+                self._filters.append((handler, log_filter))
+        super().start(titles, chapters)
+
+    def close(self):
+        super().close()
+        for handler, log_filter in self._filters:
+            handler.removeFilter(log_filter)
+        self._filters.clear()
+
+    def _format(self, status: dict) -> List[str]:
+        titles, chapters, pages = (
+            status["titles"],
+            status["chapters"],
+            status["pages"],
+        )
+        lines = [
+            f"Titles {titles[0]}/{titles[1]} | "
+            f"Chapters {chapters[0]}/{chapters[1]} | "
+            f"Pages {pages[0]}/{pages[1]} | "
+            f"{_format_size(status['bytes_per_second'])}/s | "
+            f"buffered {_format_size(status['buffered_bytes'])}"
+        ]
+        for chapter in status["active"]:
+            done, total = chapter["pages"]
+            width = 30
+            filled = width * done // total if total else width
+            bar = "#" * filled + "-" * (width - filled)
+            lines.append(f"  {chapter['chapter']} [{bar}] {done}/{total}")
+        return lines
+
+    def erase(self):
+        with self._output_lock:
+            if self._drawn_lines:
+                self.stream.write("\x1b[1A\x1b[2K" * self._drawn_lines)
+                self.stream.flush()
+                self._drawn_lines = 0
+
+    def render(self, final: bool = False):
+        lines = self._format(self.status())
+        with self._output_lock:
+            output = "\x1b[1A\x1b[2K" * self._drawn_lines
+            output += "".join(f"{line}\n" for line in lines)
+            self.stream.write(output)
+            self.stream.flush()
+            self._drawn_lines = 0 if final else len(lines)
+
+
+class JSONProgress(Progress):
+    interval = 10.0
+
+    def render(self, final: bool = False):
+        status = self.status()
+        status["final"] = final
+        self.stream.write(json.dumps(status) + "\n")
+        self.stream.flush()
+
+
+class _EraseProgressFilter(logging.Filter):
+    # Removes the progress block before a log record is printed, it is
+    # redrawn below the record on the next tick
+    def __init__(self, progress: TTYProgress):
+        super().__init__()
+        self.progress = progress
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        self.progress.erase()
+        return True
+
+
+def create_progress(
+    mode: str = "auto",
+    metrics: Optional[Metrics] = None,
+    interval: Optional[float] = None,
+    stream: TextIO = sys.stdout,
+) -> Progress:
+    if mode not in PROGRESS_MODES:
+        raise ValueError(f"Unknown progress mode: {mode}")
+    if mode == "auto":
+        mode = "tty" if stream.isatty() else "json"
+    if mode == "silent":
+        return Progress(metrics, interval, stream)
+    if mode == "json":
+        return JSONProgress(metrics, interval, stream)
+    return TTYProgress(metrics, interval, stream)
@@ -0,0 +1,91 @@
+import time
+from threading import Lock
+from typing import Dict, List, Optional
+
+from mloader.metrics import Metrics
+
+# Highest quality first
+QUALITIES = ("super_high", "high", "low")
+# Rough size of a chapter relative to super_high, used until a tier has
+# been measured
+SIZE_RATIOS = {"super_high": 1.0, "high": 0.55, "low": 0.3}
+
+
+class QualitySelector:
+    # Picks the image quality for each chapter. Starting from the requested
+    # quality, lower tiers are chosen when the measured throughput can't
+    # finish the remaining chapters before `deadline` (seconds from the
+    # start) or within `max_bytes`.
+    def __init__(
+        self,
+        quality: str,
+        metrics: Metrics,
+        deadline: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+    ):
+        self.quality = quality
+        self.metrics = metrics
+        self.deadline = deadline
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        self._started = time.monotonic()
+        self._remaining = 0
+        # Quality: [downloaded bytes, chapters]
+        self._sizes: Dict[str, List[int]] = {}
+
+    @property
+    def adaptive(self) -> bool:
+        return bool(self.deadline or self.max_bytes)
+
+    def ladder(self, quality: Optional[str] = None) -> List[str]:
+        # The given quality followed by the lower ones to fall back to
+        return list(QUALITIES[QUALITIES.index(quality or self.quality) :])
+
+    def start(self, chapters: int):
+        with self._lock:
+            self._started = time.monotonic()
+            self._remaining = chapters
+
+    def chapter_done(self, quality: str, size: int):
+        with self._lock:
+            self._remaining = max(self._remaining - 1, 0)
+            # Chapters that were already saved don't say anything about size
+            if size:
+                stats = self._sizes.setdefault(quality, [0, 0])
+                stats[0] += size
+                stats[1] += 1
+
+    def _chapter_size(self, quality: str) -> Optional[float]:
+        if quality in self._sizes:
+            size, chapters = self._sizes[quality]
+            return size / chapters
+        for measured, (size, chapters) in self._sizes.items():
+            return (
+                size / chapters * SIZE_RATIOS[quality] / SIZE_RATIOS[measured]
+            )
+        return None
+
+    def choose(self) -> str:
+        if not self.adaptive:
+            return self.quality
+        with self._lock:
+            downloaded = self.metrics.get("bytes_downloaded")
+            elapsed = time.monotonic() - self._started
+            throughput = downloaded / elapsed if elapsed and downloaded else 0
+            for quality in self.ladder():
+                chapter_size = self._chapter_size(quality)
+                if chapter_size is None:
+                    # Nothing measured yet, start optimistic
+                    return quality
+                needed = chapter_size * self._remaining
+                fits_budget = (
+                    not self.max_bytes or needed <= self.max_bytes - downloaded
+                )
+                fits_deadline = (
+                    not self.deadline
+                    or not throughput
+                    or needed / throughput <= self.deadline - elapsed
+                )
+                if fits_budget and fits_deadline:
+                    return quality
+            return QUALITIES[-1]
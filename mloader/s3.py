@@ -0,0 +1,252 @@
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from functools import partial
+from pathlib import PurePosixPath
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Set, Union
+from urllib.parse import urlparse
+
+from mloader.exporter import ExporterBase, archive_entry
+
+try:
+    import boto3
+    from botocore.config import Config
+except ImportError:  # boto3 is an optional dependency
+    boto3 = None
+
+# S3 rejects parts below 5 MiB, except for the last one
+PART_SIZE = 8 * 1024 * 1024
+
+
+def is_available() -> bool:
+    return boto3 is not None
+
+
+def is_s3_url(url: str) -> bool:
+    return url.startswith("s3://")
+
+
+class S3Storage:
+    # Bucket and key prefix of an s3:// url, shared by the exporters of a
+    # run. Uploads run on a pool of `workers` threads with a connection each.
+    # Existing objects are found by listing a whole directory at once and
+    # remembering the result, instead of a request per page.
+    def __init__(
+        self,
+        url: str,
+        endpoint_url: Optional[str] = None,
+        workers: int = 8,
+    ):
+        if not is_available():
+            raise RuntimeError(
+                "S3 export requires boto3, "
+                "install it with `pip install mloader[s3]`"
+            )
+        parsed = urlparse(url)
+        if parsed.scheme != "s3" or not parsed.netloc:
+            raise ValueError(f"Invalid S3 url: {url}")
+        self.bucket = parsed.netloc
+        self.prefix = parsed.path.strip("/")
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            config=Config(max_pool_connections=workers),
+        )
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="s3")
+        self._listed: Dict[str, Set[str]] = {}
+        self._lock = Lock()
+
+    def key(self, *parts: str) -> str:
+        return str(PurePosixPath(self.prefix, *parts)).lstrip("/")
+
+    def exists(self, key: str) -> bool:
+        directory = key.rsplit("/", 1)[0] + "/"
+        with self._lock:
+            if directory not in self._listed:
+                self._listed[directory] = self._list(directory)
+            return key in self._listed[directory]
+
+    def _list(self, directory: str) -> Set[str]:
+        keys = set()
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=directory):
+            keys.update(obj["Key"] for obj in page.get("Contents", ()))
+        return keys
+
+    def added(self, key: str):
+        directory = key.rsplit("/", 1)[0] + "/"
+        with self._lock:
+            if directory in self._listed:
+                self._listed[directory].add(key)
+
+    def put(self, key: str, data: bytes) -> Future:
+        return self._pool.submit(self._put, key, bytes(data))
+
+    def _put(self, key: str, data: bytes):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+        self.added(key)
+
+    def submit(self, fn: Callable, *args) -> Future:
+        return self._pool.submit(fn, *args)
+
+    def close(self):
+        self._pool.shutdown()
+
+
+class MultipartUpload:
+    # A write-only file object that uploads everything written to it as
+    # parts of a multipart upload while writing continues. Objects smaller
+    # than one part are sent with a single request.
+    def __init__(self, storage: S3Storage, key: str):
+        self.storage = storage
+        self.key = key
+        self._buffer = bytearray()
+        self._position = 0
+        self._upload_id: Optional[str] = None
+        self._parts: List[Future] = []
+
+    def write(self, data: bytes) -> int:
+        self._buffer += data
+        self._position += len(data)
+        if len(self._buffer) >= PART_SIZE:
+            self._send_part()
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def _send_part(self):
+        client = self.storage.client
+        if self._upload_id is None:
+            self._upload_id = client.create_multipart_upload(
+                Bucket=self.storage.bucket, Key=self.key
+            )["UploadId"]
+        part, self._buffer = bytes(self._buffer), bytearray()
+        self._parts.append(
+            self.storage.submit(
+                partial(
+                    client.upload_part,
+                    Bucket=self.storage.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    PartNumber=len(self._parts) + 1,
+                    Body=part,
+                )
+            )
+        )
+
+    def close(self):
+        if self._upload_id is None:
+            self.storage.put(self.key, self._buffer).result()
+            return
+        try:
+            if self._buffer:
+                self._send_part()
+            parts = [
+                {"ETag": future.result()["ETag"], "PartNumber": number}
+                for number, future in enumerate(self._parts, 1)
+            ]
+            self.storage.client.complete_multipart_upload(
+                Bucket=self.storage.bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except BaseException:
+            # Otherwise the uploaded parts are kept, and billed, forever
+            self.abort()
+            raise
+        self.storage.added(self.key)
+
+    def abort(self):
+        if self._upload_id is None:
+            return
+        for future in self._parts:
+            future.cancel()
+        # Parts still uploading would be kept after the abort
+        wait(self._parts)
+        self.storage.client.abort_multipart_upload(
+            Bucket=self.storage.bucket, Key=self.key, UploadId=self._upload_id
+        )
+
+
+class S3RawExporter(ExporterBase):
+    # Same layout as RawExporter, every page is a separate object
+    def __init__(self, *args, storage: S3Storage, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.storage = storage
+        self.directory = [self.title_name]
+        if self.add_chapter_subdir:
+            self.directory.append(self.chapter_name)
+        self._uploads: List[Future] = []
+
+    def _key(self, index: Union[int, range], ext: str) -> str:
+        return self.storage.key(
+            *self.directory, self.format_page_name(index, ext)
+        )
+
+    def add_image(
+        self, image_data: bytes, index: Union[int, range], ext: str = ".jpg"
+    ):
+        self._uploads.append(
+            self.storage.put(self._key(index, ext), image_data)
+        )
+
+    def skip_image(self, index: Union[int, range], ext: str = ".jpg") -> bool:
+        return self.storage.exists(self._key(index, ext))
+
+    def close(self):
+        for future in self._uploads:
+            future.result()
+
+
+class S3CBZExporter(ExporterBase):
+    # Same layout as CBZExporter. The archive is streamed into a multipart
+    # upload, nothing is written to local disk.
+    def __init__(
+        self,
+        *args,
+        storage: S3Storage,
+        compression=zipfile.ZIP_DEFLATED,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.storage = storage
+        self.compression = compression
+        name = PurePosixPath(self.chapter_name).with_suffix(".cbz").name
+        self.key = storage.key(self.title_name, name)
+        self.skip_all_images = storage.exists(self.key)
+        if not self.skip_all_images:
+            self.upload = MultipartUpload(storage, self.key)
+            self.archive = zipfile.ZipFile(
+                self.upload, mode="w", compression=compression
+            )
+
+    def add_image(
+        self, image_data: bytes, index: Union[int, range], ext: str = ".jpg"
+    ):
+        if self.skip_all_images:
+            return
+        path = PurePosixPath(
+            self.chapter_name, self.format_page_name(index, ext)
+        )
+        self.archive.writestr(
+            archive_entry(str(path), self.compression), image_data
+        )
+
+    def skip_image(self, index: Union[int, range], ext: str = ".jpg") -> bool:
+        return self.skip_all_images
+
+    def close(self):
+        if self.skip_all_images:
+            return
+        self.archive.close()
+        self.upload.close()
+
+    def checkpoint(self):
+        # Incomplete uploads can't be resumed, the chapter starts over
+        if not self.skip_all_images:
+            self.upload.abort()
@@ -0,0 +1,43 @@
+from collections import deque
+from typing import Collection, Dict, List, Tuple
+
+SCHEDULES = ("title", "fair")
+
+# Title ID, Chapter ID
+ScheduleItem = Tuple[int, int]
+
+
+def title_order(manga_list: Dict[int, Collection[int]]) -> List[ScheduleItem]:
+    # One title after another, chapters in ascending order
+    return [
+        (title_id, chapter_id)
+        for title_id, chapters in manga_list.items()
+        for chapter_id in sorted(chapters)
+    ]
+
+
+def fair_order(manga_list: Dict[int, Collection[int]]) -> List[ScheduleItem]:
+    # The newest chapter of every title goes first, titles with the least
+    # work ahead of big backfills. The remaining chapters are taken round
+    # robin, one per title, so a long title can't starve the others.
+    queues = {
+        title_id: deque(sorted(chapters))
+        for title_id, chapters in manga_list.items()
+        if chapters
+    }
+    titles = deque(sorted(queues, key=lambda title_id: len(queues[title_id])))
+    order = [(title_id, queues[title_id].pop()) for title_id in titles]
+    while titles:
+        title_id = titles.popleft()
+        if queues[title_id]:
+            order.append((title_id, queues[title_id].popleft()))
+            titles.append(title_id)
+    return order
+
+
+def create_schedule(
+    mode: str, manga_list: Dict[int, Collection[int]]
+) -> List[ScheduleItem]:
+    if mode == "fair":
+        return fair_order(manga_list)
+    return title_order(manga_list)
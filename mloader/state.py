@@ -0,0 +1,81 @@
+import json
+import os
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+
+from mloader.plan import TitlePlan
+
+STATE_VERSION = 2
+
+
+class RunState:
+    # Remaining work of an interrupted run. The next run with the same
+    # arguments continues with the saved chapter list and titles
+    # instead of fetching the metadata again.
+    def __init__(self, path: str):
+        self.path = Path(path)
+
+    def load(
+        self, request: Dict
+    ) -> Optional[Tuple[Dict[int, Set[int]], Dict[int, TitlePlan]]]:
+        try:
+            state = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return None
+        request = _normalize(request)
+        if state.get("version") != STATE_VERSION:
+            return None
+        if state.get("request") != request:
+            return None
+        manga_list = {
+            int(title_id): set(chapters)
+            for title_id, chapters in state["remaining"].items()
+        }
+        titles = {
+            int(title_id): TitlePlan.from_dict(data)
+            for title_id, data in state["titles"].items()
+        }
+        return manga_list, titles
+
+    def save(
+        self,
+        request: Dict,
+        remaining: Dict[int, Set[int]],
+        titles: Dict[int, TitlePlan],
+    ):
+        state = {
+            "version": STATE_VERSION,
+            "request": _normalize(request),
+            "remaining": {
+                str(title_id): sorted(chapters)
+                for title_id, chapters in remaining.items()
+                if chapters
+            },
+            "titles": {
+                str(title_id): title.to_dict()
+                for title_id, title in titles.items()
+                if remaining.get(title_id)
+            },
+        }
+        tmp = self.path.with_name(f"{self.path.name}.tmp")
+        tmp.write_text(json.dumps(state))
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _normalize(request: Dict) -> Dict:
+    # Round trips through json, so sets and infinity compare equal to what
+    # was saved
+    return json.loads(
+        json.dumps(
+            {
+                key: sorted(value) if isinstance(value, (set, list)) else value
+                for key, value in request.items()
+            }
+        )
+    )
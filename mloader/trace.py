@@ -0,0 +1,107 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Union
+
+
+def page_label(index: Union[int, range]) -> str:
+    if isinstance(index, range):
+        return f"{index.start}-{index.stop}"
+    return str(index)
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "args", "started")
+
+    def __init__(self, tracer: "Tracer", name: str, args: Dict):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.complete(
+            self.name, self.started, time.perf_counter(), **self.args
+        )
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    # Records spans in the Chrome trace event format, which can be loaded in
+    # chrome://tracing or Perfetto. A disabled tracer records nothing and
+    # costs one attribute lookup per span.
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._events: List[Dict] = []
+        self._threads: Dict[int, str] = {}
+        # Named tracks that don't belong to a thread of this process
+        self._tracks: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    def span(self, name: str, **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def complete(
+        self,
+        name: str,
+        started: float,
+        finished: float,
+        thread: Optional[str] = None,
+        **args,
+    ):
+        # Adds a span measured elsewhere, `thread` puts it on a separate
+        # named track, e.g. for work done in other processes
+        if not self.enabled:
+            return
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": (started - self._origin) * 1e6,
+            "dur": (finished - started) * 1e6,
+            "pid": os.getpid(),
+        }
+        if args:
+            event["args"] = args
+        with self._lock:
+            if thread is None:
+                tid = threading.get_ident()
+                thread = threading.current_thread().name
+            else:
+                tid = self._tracks.setdefault(thread, len(self._tracks) + 1)
+            event["tid"] = tid
+            self._events.append(event)
+            self._threads.setdefault(tid, thread)
+
+    def write(self, path: str):
+        with self._lock:
+            events = list(self._events)
+            threads = dict(self._threads)
+        events.extend(
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": {"name": name},
+            }
+            for tid, name in threads.items()
+        )
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events}, f)
@@ -0,0 +1,201 @@
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import partial
+from io import BytesIO
+from typing import List, Optional, Tuple, Union
+
+from mloader.trace import Tracer, page_label
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is an optional dependency
+    Image = None
+
+try:
+    # Registers the AVIF codec on Pillow versions without native support
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+PageIndex = Union[int, range]
+ProcessedPage = Tuple[PageIndex, bytes, str]
+
+DEFAULT_EXTENSION = ".jpg"
+SPLIT_MODES = ("split", "both")
+# Output format: (Pillow format name, file extension)
+IMAGE_FORMATS = {
+    "jpeg": ("JPEG", ".jpg"),
+    "webp": ("WEBP", ".webp"),
+    "avif": ("AVIF", ".avif"),
+}
+
+ProcessOptions = namedtuple(
+    "ProcessOptions",
+    "split_mode start_from_right image_format quality max_size",
+)
+
+
+def is_available() -> bool:
+    return Image is not None
+
+
+def _encode(
+    image: "Image.Image", image_format: str, quality: Optional[int] = None
+) -> bytes:
+    params = {}
+    if image_format in ("JPEG", "WEBP", "AVIF"):
+        params["quality"] = quality or 95
+    if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    buffer = BytesIO()
+    image.save(buffer, format=image_format, **params)
+    return buffer.getvalue()
+
+
+def _resize(image: "Image.Image", max_size: Optional[int]) -> "Image.Image":
+    if not max_size or max(image.size) <= max_size:
+        return image
+    image = image.copy()
+    image.thumbnail((max_size, max_size), Image.LANCZOS)
+    return image
+
+
+def split_double_page(
+    image: "Image.Image", start_from_right: bool
+) -> Tuple["Image.Image", "Image.Image"]:
+    # Halves are returned in reading order, so for right-to-left manga the
+    # right half comes first
+    width, height = image.size
+    middle = width // 2
+    left = image.crop((0, 0, middle, height))
+    right = image.crop((middle, 0, width, height))
+    return (right, left) if start_from_right else (left, right)
+
+
+def process_page(
+    image_data: bytes,
+    index: PageIndex,
+    options: ProcessOptions,
+    extension: str = DEFAULT_EXTENSION,
+) -> List[ProcessedPage]:
+    split = bool(options.split_mode) and isinstance(index, range)
+    transcode = bool(options.image_format or options.max_size)
+    if not (split or transcode):
+        return [(index, image_data, extension)]
+
+    with Image.open(BytesIO(image_data)) as image:
+        image_format, quality = image.format, None
+        if options.image_format:
+            image_format = IMAGE_FORMATS[options.image_format][0]
+            quality = options.quality
+
+        images = []
+        if not split or options.split_mode == "both":
+            images.append((index, image))
+        if split:
+            first, second = split_double_page(image, options.start_from_right)
+            images.extend(((index.start, first), (index.stop, second)))
+
+        pages = []
+        for page_index, page_image in images:
+            if page_image is image and not transcode:
+                blob = image_data
+            else:
+                blob = _encode(
+                    _resize(page_image, options.max_size),
+                    image_format,
+                    quality,
+                )
+            pages.append((page_index, blob, extension))
+        return pages
+
+
+def _timed_process_page(*args) -> Tuple[int, float, float, List]:
+    started = time.perf_counter()
+    pages = process_page(*args)
+    return os.getpid(), started, time.perf_counter(), pages
+
+
+class ImageProcessor:
+    def __init__(
+        self,
+        split_mode: Optional[str] = None,
+        image_format: Optional[str] = None,
+        quality: Optional[int] = None,
+        max_size: Optional[int] = None,
+        workers=None,
+        tracer: Optional[Tracer] = None,
+    ):
+        if not is_available():
+            raise RuntimeError(
+                "Image processing requires Pillow, "
+                "install it with `pip install mloader[images]`"
+            )
+        if split_mode is not None and split_mode not in SPLIT_MODES:
+            raise ValueError(f"Unknown split mode: {split_mode}")
+        if image_format is not None and image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Unknown image format: {image_format}")
+        self.split_mode = split_mode
+        self.image_format = image_format
+        self.quality = quality
+        self.max_size = max_size
+        self.extension = (
+            IMAGE_FORMATS[image_format][1]
+            if image_format
+            else DEFAULT_EXTENSION
+        )
+        self.tracer = tracer
+        self._pool = ProcessPoolExecutor(workers)
+
+    @property
+    def transcodes(self) -> bool:
+        return bool(self.image_format or self.max_size)
+
+    def output_indexes(self, index: PageIndex) -> List[PageIndex]:
+        if not self.split_mode or not isinstance(index, range):
+            return [index]
+        indexes = [index.start, index.stop]
+        if self.split_mode == "both":
+            indexes.insert(0, index)
+        return indexes
+
+    def needs_processing(self, index: PageIndex) -> bool:
+        return self.transcodes or self.output_indexes(index) != [index]
+
+    def submit(
+        self, image_data: bytes, index: PageIndex, start_from_right: bool
+    ) -> "Future[List[ProcessedPage]]":
+        options = ProcessOptions(
+            self.split_mode,
+            start_from_right,
+            self.image_format,
+            self.quality,
+            self.max_size,
+        )
+        args = (bytes(image_data), index, options, self.extension)
+        if not (self.tracer and self.tracer.enabled):
+            return self._pool.submit(process_page, *args)
+        # Timed in the worker, perf_counter is comparable across processes
+        result = Future()
+        timed = self._pool.submit(_timed_process_page, *args)
+        timed.add_done_callback(partial(self._trace_done, result, index))
+        return result
+
+    def _trace_done(self, result: Future, index: PageIndex, timed: Future):
+        if timed.exception() is not None:
+            result.set_exception(timed.exception())
+            return
+        pid, started, finished, pages = timed.result()
+        self.tracer.complete(
+            "process page",
+            started,
+            finished,
+            thread=f"image processor {pid}",
+            page=page_label(index),
+        )
+        result.set_result(pages)
+
+    def close(self):
+        self._pool.shutdown()
@@ -0,0 +1,185 @@
+import json
+import os
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+from pathlib import Path
+from typing import BinaryIO, Dict, Optional, Tuple
+
+from requests import Response, Session
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from mloader.utils import request_key
+
+CONDITIONAL_HEADERS = ("if-none-match", "if-modified-since")
+
+
+class TransportResponse:
+    # Mirrors the parts of requests.Response used by the loader
+    def __init__(
+        self,
+        url: str,
+        status_code: int,
+        headers: Dict[str, str],
+        content: bytes,
+        bandwidth: Optional[float] = None,
+    ):
+        self.url = url
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self._content = content
+        self._bandwidth = bandwidth
+
+    @property
+    def content(self) -> bytes:
+        if self._bandwidth:
+            time.sleep(len(self._content) / self._bandwidth)
+            self._bandwidth = None
+        return self._content
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def raw_body(resp) -> Optional[BinaryIO]:
+    # The body of a streamed requests.Response as it comes off the wire, or
+    # None when it was already read or needs decoding
+    if (
+        not isinstance(resp, Response)
+        or resp._content_consumed
+        or resp.headers.get("Content-Encoding")
+    ):
+        return None
+    return resp.raw
+
+
+class Transport(metaclass=ABCMeta):
+    @abstractmethod
+    def get(
+        self,
+        url: str,
+        params: Optional[Dict] = None,
+        headers: Optional[Dict[str, str]] = None,
+        stream: bool = False,
+    ):
+        pass
+
+    def close(self):
+        pass
+
+
+class LiveTransport(Transport):
+    # `timeout` is the connect and read timeout in seconds, the read timeout
+    # applies to every read of a streamed body rather than the whole body
+    def __init__(
+        self, pool_size: int = 10, timeout: Tuple[float, float] = (10, 60)
+    ):
+        self.timeout = timeout
+        self.session = Session()
+        self.session.headers.update(
+            {
+                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; "
+                "rv:72.0) Gecko/20100101 Firefox/72.0"
+            }
+        )
+        # Enough pooled connections for all fetch workers
+        adapter = HTTPAdapter(pool_maxsize=max(pool_size, 10))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, url, params=None, headers=None, stream=False):
+        return self.session.get(
+            url,
+            params=params,
+            headers=headers,
+            stream=stream,
+            timeout=self.timeout,
+        )
+
+    def close(self):
+        self.session.close()
+
+
+class RecordingTransport(Transport):
+    # Saves every response of the wrapped transport to `directory` so the
+    # run can be replayed offline with ReplayTransport
+    def __init__(self, transport: Transport, directory: str):
+        self.transport = transport
+        self.path = Path(directory)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def get(self, url, params=None, headers=None, stream=False):
+        # Conditional requests could be answered with a bodyless 304, which
+        # a replay couldn't serve, so the full response is always fetched
+        headers = {
+            name: value
+            for name, value in (headers or {}).items()
+            if name.lower() not in CONDITIONAL_HEADERS
+        }
+        resp = self.transport.get(url, params=params, headers=headers or None)
+        key = request_key(url, params)
+        # The body is stored decoded, drop headers describing the wire format
+        headers = {
+            name: value
+            for name, value in resp.headers.items()
+            if name.lower() not in ("content-encoding", "transfer-encoding")
+        }
+        headers["Content-Length"] = str(len(resp.content))
+        meta = {
+            "url": url,
+            "params": params,
+            "status_code": resp.status_code,
+            "headers": headers,
+        }
+        self._write(f"{key}.bin", resp.content)
+        self._write(f"{key}.json", json.dumps(meta, default=str).encode())
+        return resp
+
+    def _write(self, name: str, data: bytes):
+        # Concurrent fetches of the same url write the same file
+        tmp = self.path.joinpath(f"{name}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, self.path.joinpath(name))
+
+    def close(self):
+        self.transport.close()
+
+
+class ReplayTransport(Transport):
+    # Serves responses saved by RecordingTransport, optionally simulating
+    # network latency (seconds) and bandwidth (bytes per second)
+    def __init__(
+        self,
+        directory: str,
+        latency: float = 0.0,
+        bandwidth: Optional[float] = None,
+    ):
+        self.path = Path(directory)
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    def get(self, url, params=None, headers=None, stream=False):
+        key = request_key(url, params)
+        try:
+            meta = json.loads(self.path.joinpath(f"{key}.json").read_text())
+            content = self.path.joinpath(f"{key}.bin").read_bytes()
+        except FileNotFoundError:
+            raise FileNotFoundError(
+                f"No recorded response for {url} {params or ''}"
+            )
+        if self.latency:
+            time.sleep(self.latency)
+        resp = TransportResponse(
+            url, meta["status_code"], meta["headers"], content, self.bandwidth
+        )
+        if not stream:
+            # Non streaming requests pay for the body before returning
+            resp.content
+        return resp
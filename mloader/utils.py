@@ -1,7 +1,10 @@
+import hashlib
+import json
 import re
 import string
 import sys
-from typing import Optional
+from pathlib import Path
+from typing import Dict, Optional, Union
 
 
 def is_oneshot(chapter_name: str, chapter_subtitle: str) -> bool:
@@ -30,3 +33,16 @@ def escape_path(path: str) -> str:
 
 def is_windows() -> bool:
     return sys.platform == "win32"
+
+
+def request_key(url: str, params: Optional[Dict] = None) -> str:
+    query = json.dumps([url, sorted((params or {}).items())], default=str)
+    return hashlib.sha1(query.encode()).hexdigest()
+
+
+def file_digest(path: Union[str, Path]) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
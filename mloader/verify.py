@@ -0,0 +1,160 @@
+import struct
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".avif")
+ARCHIVE_EXTENSIONS = (".cbz", ".zip")
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_PNG_END = b"IEND\xaeB`\x82"
+# Start of frame markers, they carry the image dimensions
+_JPEG_SOF = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Markers without a length field
+_JPEG_STANDALONE = {0x01, *range(0xD0, 0xD8)}
+
+
+class CorruptImageError(Exception):
+    pass
+
+
+def _jpeg_size(data: bytes) -> Optional[Tuple[int, int]]:
+    pos = 2
+    size = len(data)
+    while pos + 4 <= size:
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:  # Fill byte
+            pos += 1
+            continue
+        if marker in _JPEG_STANDALONE:
+            pos += 2
+            continue
+        if marker in _JPEG_SOF:
+            if pos + 9 > size:
+                return None
+            height, width = struct.unpack(">HH", data[pos + 5 : pos + 9])
+            return width, height
+        if marker == 0xDA:  # Start of scan without a frame header
+            return None
+        (length,) = struct.unpack(">H", data[pos + 2 : pos + 4])
+        pos += 2 + length
+    return None
+
+
+def _webp_size(data: bytes) -> Optional[Tuple[int, int]]:
+    chunk = data[12:16]
+    if chunk == b"VP8 " and len(data) >= 30:
+        if data[23:26] != b"\x9d\x01\x2a":
+            return None
+        width, height = struct.unpack("<HH", data[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L" and len(data) >= 25:
+        if data[20] != 0x2F:
+            return None
+        (bits,) = struct.unpack("<I", data[21:25])
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X" and len(data) >= 30:
+        width = int.from_bytes(data[24:27], "little") + 1
+        height = int.from_bytes(data[27:30], "little") + 1
+        return width, height
+    return None
+
+
+def image_info(data: bytes) -> Tuple[Optional[str], Optional[Tuple[int, int]]]:
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpeg", _jpeg_size(data)
+    if data[:8] == _PNG_SIGNATURE:
+        if data[12:16] != b"IHDR":
+            return "png", None
+        return "png", struct.unpack(">II", data[16:24])
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp", _webp_size(data)
+    if data[4:8] == b"ftyp" and data[8:12] in (b"avif", b"avis"):
+        return "avif", None
+    return None, None
+
+
+def _is_complete(image_format: str, data: bytes) -> bool:
+    if image_format == "jpeg":
+        # Some encoders pad the file after the end of image marker
+        return data.rstrip(b"\x00").endswith(b"\xff\xd9")
+    if image_format == "png":
+        return data.endswith(_PNG_END)
+    if image_format == "webp":
+        (riff_size,) = struct.unpack("<I", data[4:8])
+        return len(data) >= riff_size + 8
+    return True
+
+
+def _same_shape(actual: Tuple[int, int], expected: Tuple[int, int]) -> bool:
+    if actual == expected:
+        return True
+    # Lower quality tiers are served downscaled, accept the same aspect ratio
+    (width, height), (exp_width, exp_height) = actual, expected
+    return abs(width * exp_height - height * exp_width) <= (
+        0.01 * exp_width * height
+    )
+
+
+def check_image(data: bytes, width: int = 0, height: int = 0) -> Optional[str]:
+    if not data:
+        return "empty image"
+    image_format, size = image_info(data)
+    if image_format is None:
+        return "unknown image format"
+    if image_format != "avif" and size is None:
+        return f"invalid {image_format} header"
+    if not _is_complete(image_format, data):
+        return f"truncated {image_format} image"
+    if size and width and height and not _same_shape(size, (width, height)):
+        return (
+            f"unexpected image size {size[0]}x{size[1]}, "
+            f"expected {width}x{height}"
+        )
+    return None
+
+
+def verify_file(path: Path) -> List[str]:
+    problems = []
+    if path.suffix.lower() in ARCHIVE_EXTENSIONS:
+        try:
+            with zipfile.ZipFile(path) as archive:
+                bad_entry = archive.testzip()
+                if bad_entry:
+                    problems.append(f"{bad_entry}: bad CRC")
+                for entry in archive.infolist():
+                    if entry.is_dir() or entry.filename == bad_entry:
+                        continue
+                    if not entry.filename.lower().endswith(IMAGE_EXTENSIONS):
+                        continue
+                    error = check_image(archive.read(entry))
+                    if error:
+                        problems.append(f"{entry.filename}: {error}")
+        except (zipfile.BadZipFile, OSError) as e:
+            problems.append(f"bad archive: {e}")
+    else:
+        try:
+            error = check_image(path.read_bytes())
+        except OSError as e:
+            error = str(e)
+        if error:
+            problems.append(error)
+    return problems
+
+
+def find_library_files(directory: str) -> Iterator[Path]:
+    extensions = IMAGE_EXTENSIONS + ARCHIVE_EXTENSIONS
+    for path in sorted(Path(directory).rglob("*")):
+        if path.is_file() and path.suffix.lower() in extensions:
+            yield path
+
+
+def scan_library(
+    directory: str, workers: Optional[int] = None
+) -> Iterator[Tuple[Path, List[str]]]:
+    paths = list(find_library_files(directory))
+    with ProcessPoolExecutor(workers) as pool:
+        yield from zip(paths, pool.map(verify_file, paths, chunksize=16))
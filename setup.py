@@ -31,6 +31,7 @@ setup(
         "protobuf~=3.6",
         "requests>=2"
     ],
+    extras_require={"images": ["Pillow>=8"], "s3": ["boto3>=1.9"]},
     license=about["__license__"],
     zip_safe=False,
     classifiers=[